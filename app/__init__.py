@@ -7,11 +7,11 @@ import os
 from logging.config import dictConfig
 
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache
 from flask_assets import Environment, Bundle
 from flask_babel import Babel, _
 from flask_login import LoginManager
 from flask_mail import Mail
-from flask_migrate import Migrate
 from flask_misaka import Misaka
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
@@ -20,7 +20,10 @@ import webassets
 
 from .bootstrap import BASE_CONFIG, FORCED_CONFIG
 from .errors import forbidden_403, not_found_404, server_error_500
-from .helpers import CeleryWrapper, CryptoManager, HashidsWrapper
+from .helpers import CeleryWrapper, CryptoManager, FragmentCache, \
+    HashidsWrapper, IconBundle, IconSprite, LoginThrottle, MailPool, \
+    PrincipalCache, Metrics, QueryMonitor, RequestProfiler, \
+    ResponseCompressor, StartupTimer
 
 __version__ = '1.0.0'
 
@@ -41,17 +44,6 @@ dictConfig({
     }
 })
 
-# Debug toolbar (for development)
-try:
-    from flask_debugtoolbar import DebugToolbarExtension
-    toolbar = DebugToolbarExtension()
-
-    _USING_TOOLBAR = True
-
-except ImportError:
-    _USING_TOOLBAR = False
-
-
 # Crypto
 crypto_manager = CryptoManager()
 
@@ -67,21 +59,42 @@ csrf = CSRFProtect()
 # SQLAlchemy
 db = SQLAlchemy()
 
-# Flask-Migrate
-migrate = Migrate()
+# Slow and repeated queries detection
+query_monitor = QueryMonitor()
 
 # Flask-Mail
 mail = Mail()
 
+# Persistent SMTP connections
+mail_pool = MailPool(mail)
+
 # Flask-Login
 login_manager = LoginManager()
 
+# Cache for users loaded by Flask-Login
+user_cache = PrincipalCache()
+
+# Login attempts throttle
+login_throttle = LoginThrottle()
+
+# Cache for rendered template fragments
+fragment_cache = FragmentCache()
+
 # Celery (optional)
 celery = CeleryWrapper()
 
 # Flask-Assets
 assets = Environment()
 
+# Request metrics (optional)
+metrics = Metrics()
+
+# Profiling of sampled requests (optional)
+profiler = RequestProfiler()
+
+# Response compression (optional)
+compressor = ResponseCompressor()
+
 # Flask-Misaka
 md = Misaka(
     fenced_code=False,
@@ -100,6 +113,7 @@ from . import util
 
 def init_app() -> Flask:
     """Initialize application."""
+    timer = StartupTimer()
     app = Flask(__name__)
     app.config.update(BASE_CONFIG)
 
@@ -120,46 +134,95 @@ def init_app() -> Flask:
 
     # Misc configurations
     app.config['ASSETS_AUTO_BUILD'] = False if app.config['ENV'] == 'production' else True
+    # Bundle names include their hash, resolved through the manifest generated
+    # by `myapp assets build`
+    app.config['ASSETS_MANIFEST'] = 'json:dist/manifest.json'
+    app.config['ASSETS_URL_EXPIRE'] = False
     app.config['__version__'] = __version__
 
     # Custom jinja helpers
     app.jinja_env.filters['datetime'] = util.format_datetime
+    app.jinja_env.filters['datetimes'] = util.format_datetimes
     app.jinja_env.globals['url_for_self'] = util.url_for_self
+    app.jinja_env.globals['svg_icon'] = util.svg_icon
 
     # Whitespacing Jinja
     app.jinja_env.trim_blocks = True
     app.jinja_env.lstrip_blocks = True
 
+    # Load templates compiled with `myapp templates compile` in production
+    if not app.config.get('TEMPLATES_CACHE_DIR'):
+        app.config['TEMPLATES_CACHE_DIR'] = os.path.join(
+            app.instance_path,
+            'templates_cache'
+        )
+
+    if app.config['ENV'] == 'production' and \
+            os.path.isdir(app.config['TEMPLATES_CACHE_DIR']):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATES_CACHE_DIR']
+        )
+
+    timer.mark('config')
+
+    # Setup request metrics and response compression before any other
+    # extension: `after_request` functions run in reverse order of
+    # registration, so compression runs after the rest of them (e.g. once the
+    # debug toolbar injects its HTML) and the metrics, including every other
+    # function, run last
+    metrics.init_app(app)
+    timer.mark('metrics')
+    compressor.init_app(app)
+    timer.mark('compression')
+
     # Setup debug toolbar in development
-    if app.config.get('DEBUG') and _USING_TOOLBAR:
-        toolbar.init_app(app)
+    if app.config.get('DEBUG'):
+        try:
+            # The toolbar is optional, import it here rather than globally
+            from flask_debugtoolbar import DebugToolbarExtension
+            DebugToolbarExtension(app)
+
+        except ImportError:
+            pass
+
+    timer.mark('toolbar')
 
     # Setup cryptography (passlib)
     crypto_manager.init_app(app)
+    timer.mark('crypto')
 
     # Setup Hashids
     user_hasher.init_app(
         salt=app.config['USER_HASHID_SALT'],
         length=app.config['USER_HASHID_LENGTH']
     )
+    timer.mark('hashids')
 
     # Setup localization
     babel.init_app(app)
+    timer.mark('babel')
 
     # Setup CSRF protection
     csrf.init_app(app)
+    timer.mark('csrf')
 
-    # Setup database
+    # Setup database (migrations are only set up for CLI commands, see
+    # `cli.create_app()`)
     db.init_app(app)
     # Force model registration
     from . import models
-
-    # Database migrations
-    migrations_dir = os.path.join(app.root_path, 'migrations')
-    migrate.init_app(app, db, migrations_dir)
+    query_monitor.init_app(app)
+    timer.mark('database')
 
     # Setup Flask-Mail
     mail.init_app(app)
+    mail_pool.init_app(app)
+    timer.mark('mail')
+
+    # Account password hashing and emails in request metrics
+    metrics.instrument(crypto_manager, 'hash', 'verify', 'verify_and_update', component='crypto')
+    metrics.instrument(mail_pool, 'send', component='mail')
+    timer.mark('instrumentation')
 
     # Celery support (optional)
     if app.config.get('USE_CELERY', False):
@@ -168,6 +231,18 @@ def init_app() -> Flask:
         # Import tasks
         from .async_tasks import async_mail
 
+    timer.mark('celery')
+
+    # Setup user cache
+    user_cache.init_app(app)
+
+    # Setup login throttle
+    login_throttle.init_app(app)
+
+    # Setup fragment cache
+    fragment_cache.init_app(app)
+    timer.mark('caches')
+
     # Setup Flask-Login
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
@@ -185,6 +260,9 @@ def init_app() -> Flask:
 
         Note that this also checks whether the user is active or not.
 
+        Active users are cached in the `user_cache` to avoid querying the
+        database on every request.
+
         Args:
             user_id (str): User ID in format 'ID_serial'.
 
@@ -193,15 +271,23 @@ def init_app() -> Flask:
         """
         uid, serial = user_id.split('_', 1)
 
-        user = (
-            models.User.query
-            .filter_by(id=uid)
-            .filter_by(serial=serial)
-            .filter_by(is_active=True)
-        ).first()
+        cached = user_cache.get(uid, serial)
+
+        if cached is not None:
+            return models.User.from_cache(cached)
+
+        # Obtained before querying, so that the user is not cached if it is
+        # modified in the meantime
+        version = user_cache.version(uid)
+        user = models.User.session_query(uid, serial).first()
+
+        if user:
+            user_cache.set(uid, serial, user.to_cache(), version)
 
         return user
 
+    timer.mark('login')
+
     # Setup Flask-Assets and bundles
     assets.init_app(app)
 
@@ -209,32 +295,50 @@ def init_app() -> Flask:
     css_bundle = Bundle(
         Bundle('app.scss', filters=libsass),
         filters='rcssmin',
-        output='dist/app.css'
+        output='dist/app.%(version)s.css'
     )
 
-    js_bundle = Bundle(
+    # Javascript is split in libraries, which change rarely and remain cached
+    # between deployments, and application code. Pages needing additional
+    # scripts should register their own bundles and include them in the
+    # `scripts` block of the layout
+    vendor_js_bundle = Bundle(
         'node_modules/jquery/dist/jquery.min.js',
         Bundle(
-            'node_modules/@fortawesome/fontawesome-free/js/fontawesome.min.js',
-            'node_modules/@fortawesome/fontawesome-free/js/solid.min.js',
             'node_modules/noty/lib/noty.min.js',
             filters='rjsmin'
         ),
-        # Import in order of dependency, init.js should be the last
-        Bundle(
-            'js/util.js',
-            'js/navigation.js',
-            'js/init.js',
-            filters='rjsmin'
-        ),
-        output='dist/app.js'
+        output='dist/vendor.%(version)s.js'
+    )
+
+    # Import in order of dependency, init.js should be the last
+    js_bundle = Bundle(
+        'js/util.js',
+        'js/navigation.js',
+        'js/init.js',
+        filters='rjsmin',
+        output='dist/app.%(version)s.js'
+    )
+
+    # Only the icons referenced in templates are included in the sprite,
+    # along with those given through variables, which must be configured
+    icons_bundle = IconBundle(
+        app.jinja_env,
+        os.path.join(app.root_path, app.template_folder),
+        app.config['ASSETS_EXTRA_ICONS'],
+        filters=(IconSprite(),),
+        output='dist/icons.%(version)s.svg'
     )
 
     assets.register('css_pack', css_bundle)
+    assets.register('vendor_js_pack', vendor_js_bundle)
     assets.register('js_pack', js_bundle)
+    assets.register('icons', icons_bundle)
+    timer.mark('assets')
 
     # Setup Flask-Misaka
     md.init_app(app)
+    timer.mark('misaka')
 
     # Register blueprints
     from .views.auth import bp_auth
@@ -242,14 +346,29 @@ def init_app() -> Flask:
 
     app.register_blueprint(bp_auth)
     app.register_blueprint(bp_general)
-
-    # Custom commands
-    from . import cli
+    timer.mark('blueprints')
 
     # Custom error handlers
     app.register_error_handler(403, forbidden_403)
     app.register_error_handler(404, not_found_404)
     app.register_error_handler(500, server_error_500)
 
+    # Fingerprinted assets never change
+    app.after_request(util.set_asset_cache_headers)
+
+    # Setup profiling of sampled requests around the WSGI application
+    profiler.init_app(app)
+    timer.mark('profiler')
+
+    # Warm up without database connections, as workers may be forked from
+    # this process. See `deployment/wsgi.py` for the hooks run in each worker
+    if app.config.get('WARM_UP'):
+        with app.app_context():
+            util.warm_up(connections=0)
+
+        timer.mark('warm_up')
+
+    # Reported by `myapp profile-startup`
+    app.extensions['startup_timings'] = timer.timings
 
     return app
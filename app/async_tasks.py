@@ -6,14 +6,48 @@ The `celery` package must be installed and the backend must be enabled and
 configured with the `USE_CELERY` and `CELERY_*` parameters, respectively.
 """
 
+from flask import current_app
 from flask_mail import Message
 
-from . import celery, mail
+from . import celery, mail_pool
+from .util import drain_outbox, load_context, render_email
 
 
 # Important! Always name your tasks
 @celery.task(name='myapp.async_tasks.async_mail', ignore_result=True)
-def async_mail(*args, **kwargs):
-    """Send Flask-Mail emails asynchronously."""
+def async_mail(*args, template=None, context=None, locale=None,
+               timezone=None, base_url=None, **kwargs):
+    """Send Flask-Mail emails asynchronously.
+
+    If a `template` is given, it is rendered here with the context, locale
+    and timezone prepared by `util.send_email()`, in a request context for
+    the `base_url` of the original request so that external URLs are built
+    correctly.
+
+    Messages are sent through the pool of persistent SMTP connections of the
+    worker process.
+    """
+    if template is not None:
+        with current_app.test_request_context(base_url=base_url):
+            kwargs['body'] = render_email(
+                template,
+                locale,
+                timezone,
+                **load_context(context or {})
+            )
+
     message = Message(*args, **kwargs)
-    mail.send(message)
+    mail_pool.send(message)
+
+
+@celery.task(name='myapp.async_tasks.drain_mail_outbox', ignore_result=True)
+def drain_mail_outbox(batch_size=100):
+    """Send pending messages from the mail outbox.
+
+    This task is meant to be scheduled periodically with Celery beat.
+    """
+    while True:
+        sent, failed = drain_outbox(batch_size)
+
+        if sent + failed < batch_size:
+            break
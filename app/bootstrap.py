@@ -27,12 +27,56 @@ BASE_CONFIG = {
     'SITENAME': 'My App',
     'ITEMS_PER_PAGE': 10,
     'LANGUAGES': LANGUAGES,
+    'TEMPLATES_CACHE_DIR': None,
+    'WARM_UP': False,
+    'WARM_UP_CONNECTIONS': 1,
+
+    # Assets
+    'ASSETS_CACHE_MAX_AGE': 365 * 24 * 60 * 60, # 1 year
+    'ASSETS_EXTRA_ICONS': [],
+
+    # Compression
+    'COMPRESS_ENABLED': False,
+    'COMPRESS_MIN_SIZE': 500,
+    'COMPRESS_MIMETYPES': [
+        'application/javascript',
+        'application/json',
+        'application/xml',
+        'image/svg+xml',
+        'text/css',
+        'text/csv',
+        'text/html',
+        'text/javascript',
+        'text/plain',
+        'text/xml',
+    ],
+    'COMPRESS_LEVEL': 6,
+    'COMPRESS_BROTLI_QUALITY': 4,
+
+    # Metrics
+    'METRICS_ENABLED': False,
+    'METRICS_ENDPOINT': '/metrics',
+    'METRICS_ALLOWED_ADDRESSES': ['127.0.0.1', '::1'],
+    'METRICS_DIR': None,
+    'METRICS_SERVER_TIMING': None,
+
+    # Profiling
+    'PROFILER_ENABLED': False,
+    'PROFILER_DIR': None,
+    'PROFILER_SAMPLE_RATE': 0.0,
+    'PROFILER_HEADER': 'X-Profile',
+    'PROFILER_HEADER_MAX_AGE': 60 * 60, # 1 hour
+    'PROFILER_MAX_FILES': 1000,
 
     # Uploads
     'MAX_CONTENT_LENGTH': 4 * 1024 * 1024, # 4 MB
 
     # Flask-SQLAlchemy
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'QUERY_MONITOR_ENABLED': None,
+    'QUERY_MONITOR_SLOW_THRESHOLD': 0.5,
+    'QUERY_MONITOR_REPEATED_THRESHOLD': 5,
+    'QUERY_MONITOR_STACK_DEPTH': 5,
 
     # Hashids
     'USER_HASHID_LENGTH': 10,
@@ -46,6 +90,35 @@ BASE_CONFIG = {
     'PASSLIB_SCHEMES': ['bcrypt'],
     'PASSLIB_DEPRECATED': ['auto'],
     'PASSLIB_ALG_BCRYPT_ROUNDS': 14,
+    'PASSLIB_EXECUTOR': None,
+    'PASSLIB_EXECUTOR_WORKERS': None,
+    'PASSLIB_EXECUTOR_QUEUE_SIZE': None,
+
+    # Caching
+    'CACHE_REDIS_URL': None,
+    'USER_CACHE_ENABLED': None,
+    'USER_CACHE_SIZE': 1024,
+    'USER_CACHE_TTL': 15,
+    'FRAGMENT_CACHE_ENABLED': True,
+    'FRAGMENT_CACHE_SIZE': 1024,
+    'FRAGMENT_CACHE_TTL': 300,
+
+    # Mail
+    'MAIL_POOL_ENABLED': True,
+    'MAIL_POOL_SIZE': 2,
+    'MAIL_POOL_MAX_MESSAGES': 100,
+    'MAIL_POOL_IDLE_TIMEOUT': 30,
+    'MAIL_OUTBOX': False,
+    'MAIL_OUTBOX_MAX_ATTEMPTS': 5,
+    'MAIL_OUTBOX_BACKOFF': 60,
+
+    # Login throttling
+    'LOGIN_THROTTLE_ENABLED': True,
+    'LOGIN_THROTTLE_IP_BURST': 20,
+    'LOGIN_THROTTLE_IP_PER_MINUTE': 10,
+    'LOGIN_THROTTLE_IDENTITY_BURST': 5,
+    'LOGIN_THROTTLE_IDENTITY_PER_MINUTE': 2,
+    'LOGIN_THROTTLE_SIZE': 65536,
 }
 
 
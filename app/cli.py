@@ -2,15 +2,57 @@
 
 """CLI commands."""
 
+import collections
+import csv
+import glob
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import statistics
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
 import click
-from flask.cli import FlaskGroup
-from sqlalchemy import exc as dbexc
+from flask import current_app
+from flask.cli import FlaskGroup, with_appcontext
+from flask_assets import assets as assets_cli
+from flask_migrate import Migrate
+from flask_migrate.cli import db as db_cli
+from jinja2 import FileSystemBytecodeCache
+from passlib.registry import get_crypt_handler
+from sqlalchemy import exc as dbexc, or_, select
+from webassets.script import CommandLineEnvironment
+
+from . import db, crypto_manager, init_app, profiler
+from .bootstrap import LANGUAGES
+from .forms import TIMEZONES
+from .util import drain_outbox
+from .models import User, hot_queries
+
+
+# Flask-Migrate, only needed by the `db` commands
+migrate = Migrate()
 
-from . import db, crypto_manager, init_app
-from .models import User
 
+def create_app():
+    """Initialize the application for CLI commands."""
+    app = init_app()
 
-@click.group(cls=FlaskGroup, create_app=init_app)
+    # Database migrations
+    migrations_dir = os.path.join(app.root_path, 'migrations')
+    migrate.init_app(app, db, migrations_dir)
+
+    return app
+
+
+@click.group(cls=FlaskGroup, create_app=create_app)
 def cli():
     """App CLI."""
     pass
@@ -60,6 +102,338 @@ def create_user(username: str, email: str, password: str):
             db.session.rollback()
 
 
+def _read_users(source, fmt: str):
+    """Iterate over the `(line, row)` pairs of a CSV or JSON Lines stream."""
+    if fmt == 'csv':
+        # Header is line 1
+        for line, row in enumerate(csv.DictReader(source), 2):
+            yield line, row
+
+        return
+
+    for line, raw in enumerate(source, 1):
+        if not raw.strip():
+            continue
+
+        try:
+            yield line, json.loads(raw)
+
+        except ValueError:
+            # Reported along with the rest of invalid rows
+            yield line, None
+
+
+# Strings accepted as booleans in CSV and JSON rows
+_TRUE_VALUES = ('1', 'true', 'yes', 'y')
+_FALSE_VALUES = ('0', 'false', 'no', 'n')
+
+
+def _parse_bool(value, default: bool) -> bool:
+    """Parse a boolean value obtained from a CSV or JSON row.
+
+    Raises:
+        `ValueError` if the value is not a boolean, number or known string.
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return default
+
+    if isinstance(value, str) and value.strip().lower() in _TRUE_VALUES:
+        return True
+
+    if isinstance(value, str) and value.strip().lower() in _FALSE_VALUES:
+        return False
+
+    if not isinstance(value, (bool, int, float)):
+        raise ValueError('"is_active" must be a boolean')
+
+    return bool(value)
+
+
+def _parse_user(row, default_locale: str, default_timezone: str,
+                hashed: bool = False) -> dict:
+    """Obtain the values of a user from a CSV or JSON row.
+
+    Values are validated as in the signup form, so that they can be inserted
+    without errors from the database.
+
+    Raises:
+        `ValueError` describing why the row is invalid.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('not a valid JSON object')
+
+    for field in ('username', 'email', 'password', 'locale', 'timezone'):
+        if row.get(field) is not None and not isinstance(row[field], str):
+            raise ValueError('"{}" must be a string'.format(field))
+
+    values = {
+        'username': (row.get('username') or '').strip(),
+        'email': (row.get('email') or '').strip(),
+        'password': row.get('password') or '',
+        'is_active': _parse_bool(row.get('is_active'), default=True),
+        'locale': (row.get('locale') or '').strip() or default_locale,
+        'timezone': (row.get('timezone') or '').strip() or default_timezone,
+    }
+
+    if not values['username'] or not values['email'] or not values['password']:
+        raise ValueError('missing required fields')
+
+    for field in ('username', 'email'):
+        if len(values[field]) > User.__table__.c[field].type.length:
+            raise ValueError('"{}" is too long'.format(field))
+
+    if values['locale'] not in LANGUAGES:
+        raise ValueError('unknown locale "{}"'.format(values['locale']))
+
+    if values['timezone'] not in TIMEZONES:
+        raise ValueError('unknown timezone "{}"'.format(values['timezone']))
+
+    if hashed and not crypto_manager.identify(values['password']):
+        raise ValueError('"password" is not a supported hash')
+
+    return values
+
+
+@user.command('import')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='input format [default: guessed from extension]')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='users to insert per transaction')
+@click.option('--workers', type=int,
+              help='processes hashing passwords [default: CPUs]')
+@click.option('--hashed', is_flag=True,
+              help='passwords are already hashed')
+def import_users(source, fmt: str, batch_size: int, workers: int, hashed: bool):
+    """Import users from a CSV or JSON Lines file.
+
+    Every row must contain the "username", "email" and "password" fields and
+    may contain the "is_active" (defaults to true), "locale" and "timezone"
+    fields. Use "-" as SOURCE to read from the standard input.
+
+    Rows that are invalid or already exist are reported and skipped.
+    """
+    if not fmt:
+        fmt = 'csv' if source.name.endswith('.csv') else 'jsonl'
+
+    default_locale = current_app.config.get('BABEL_DEFAULT_LOCALE', 'en')
+    default_timezone = current_app.config.get('BABEL_DEFAULT_TIMEZONE', 'UTC')
+
+    pool = None if hashed else crypto_manager.process_pool(workers)
+    rows = _read_users(source, fmt)
+
+    imported, skipped = 0, 0
+    start = time.perf_counter()
+
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+
+            if not batch:
+                break
+
+            # Validate rows and discard duplicates before hashing
+            valid = []
+            usernames, emails = set(), set()
+
+            for line, row in batch:
+                try:
+                    values = _parse_user(row, default_locale, default_timezone, hashed)
+
+                except ValueError as e:
+                    click.echo('Line {}: {}'.format(line, e), err=True)
+                    skipped += 1
+                    continue
+
+                if values['username'] in usernames or values['email'] in emails:
+                    click.echo('Line {}: duplicated in input'.format(line), err=True)
+                    skipped += 1
+
+                else:
+                    usernames.add(values['username'])
+                    emails.add(values['email'])
+                    valid.append((line, values))
+
+            existing = (
+                db.session.query(User.username, User.email)
+                .filter(or_(User.username.in_(usernames), User.email.in_(emails)))
+            ).all()
+            existing_usernames = {u for u, _ in existing}
+            existing_emails = {e for _, e in existing}
+
+            new = []
+
+            for line, values in valid:
+                if values['username'] in existing_usernames or \
+                        values['email'] in existing_emails:
+                    click.echo('Line {}: user already exists'.format(line), err=True)
+                    skipped += 1
+
+                else:
+                    new.append((line, values))
+
+            if not hashed:
+                hashes = crypto_manager.hash_many([v['password'] for _, v in new], pool)
+
+                for (_, values), password in zip(new, hashes):
+                    values['password'] = password
+
+            inserted = _insert_users(new)
+            imported += inserted
+            skipped += len(new) - inserted
+
+            elapsed = time.perf_counter() - start
+            click.echo('Imported {} users, skipped {} ({:.1f} rows/s)'.format(
+                imported,
+                skipped,
+                (imported + skipped) / elapsed
+            ), err=True)
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    click.echo('Import finished: {} users imported, {} skipped'.format(imported, skipped))
+
+
+def _insert_users(rows: list) -> int:
+    """Insert a batch of users in a single transaction.
+
+    If the batch fails because of a conflicting user created concurrently (or
+    values rejected by the database), users are inserted one by one in order
+    to skip the failing ones.
+
+    Args:
+        rows (list): List of `(line, values)` tuples.
+
+    Returns:
+        Number of inserted users.
+    """
+    if not rows:
+        return 0
+
+    try:
+        db.session.execute(User.__table__.insert(), [v for _, v in rows])
+        db.session.commit()
+
+        return len(rows)
+
+    except (dbexc.IntegrityError, dbexc.DataError):
+        db.session.rollback()
+
+    inserted = 0
+
+    for line, values in rows:
+        try:
+            db.session.execute(User.__table__.insert(), values)
+            db.session.commit()
+            inserted += 1
+
+        except (dbexc.IntegrityError, dbexc.DataError) as e:
+            db.session.rollback()
+            click.echo('Line {}: {}'.format(line, e.orig), err=True)
+
+    return inserted
+
+
+# Columns included in user listings and exports
+_USER_COLUMNS = (
+    'id', 'username', 'email', 'is_active', 'locale', 'timezone',
+    'invitations', 'joined_at'
+)
+
+
+def _user_filter_options(f):
+    """Add the options to filter user listings to a command."""
+    options = [
+        click.option('--active/--inactive', default=None,
+                     help='only active or inactive users'),
+        click.option('--joined-after', type=click.DateTime(),
+                     help='only users that joined at or after this date (UTC)'),
+        click.option('--joined-before', type=click.DateTime(),
+                     help='only users that joined before this date (UTC)'),
+        click.option('--locale', help='only users with this locale'),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
+def _stream_users(active, joined_after, joined_before, locale, batch_size=1000):
+    """Iterate over the rows of the users table matching the filters.
+
+    Rows are fetched with a server-side cursor (where supported) in batches
+    and are not loaded into the ORM, so memory usage is constant.
+    """
+    table = User.__table__
+    stmt = select(*[table.c[c] for c in _USER_COLUMNS]).order_by(table.c.id)
+
+    if active is not None:
+        stmt = stmt.where(table.c.is_active == active)
+
+    if joined_after:
+        stmt = stmt.where(table.c.joined_at >= joined_after)
+
+    if joined_before:
+        stmt = stmt.where(table.c.joined_at < joined_before)
+
+    if locale:
+        stmt = stmt.where(table.c.locale == locale)
+
+    result = db.session.execute(stmt.execution_options(stream_results=True))
+
+    for row in result.yield_per(batch_size):
+        yield row
+
+
+@user.command('list')
+@_user_filter_options
+def list_users(active, joined_after, joined_before, locale):
+    """List users in the database."""
+    total = 0
+
+    for row in _stream_users(active, joined_after, joined_before, locale):
+        total += 1
+        click.echo('{} <{}> [{}] joined {} UTC'.format(
+            row.username,
+            row.email,
+            'active' if row.is_active else 'inactive',
+            row.joined_at.strftime('%Y-%m-%d %H:%M:%S')
+        ))
+
+    click.echo('Total: {}'.format(total))
+
+
+@user.command('export')
+@_user_filter_options
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              default='csv', show_default=True, help='output format')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-',
+              help='file to write to [default: standard output]')
+def export_users(active, joined_after, joined_before, locale, fmt: str, output):
+    """Export users in the database as CSV or JSON Lines.
+
+    Passwords and tokens are never exported.
+    """
+    rows = _stream_users(active, joined_after, joined_before, locale)
+
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(_USER_COLUMNS)
+
+        for row in rows:
+            writer.writerow(row)
+
+        return
+
+    for row in rows:
+        values = dict(row._mapping)
+        values['joined_at'] = values['joined_at'].isoformat()
+        output.write(json.dumps(values) + '\n')
+
+
 @user.command('info')
 @click.option('--username', help='username to search (priority over email)')
 @click.option('--email', help='email to search')
@@ -198,5 +572,577 @@ def change_password(username: str, password: str):
             db.session.rollback()
 
 
+# Begin mail commands
+@cli.group()
+def mail():
+    """Mail commands."""
+    pass
+
+
+@mail.command('drain')
+@click.option('--batch-size', default=100, show_default=True,
+              help='messages to send per transaction')
+@click.option('--loop', is_flag=True, help='keep waiting for new messages')
+@click.option('--interval', default=5, show_default=True,
+              help='seconds to wait when the outbox is empty (with --loop)')
+def drain_mail(batch_size: int, loop: bool, interval: int):
+    """Send pending messages from the mail outbox."""
+    while True:
+        sent, failed = drain_outbox(batch_size)
+
+        if sent or failed:
+            click.echo('Sent {} messages, {} failed'.format(sent, failed))
+
+        if sent + failed < batch_size:
+            if not loop:
+                break
+
+            time.sleep(interval)
+
+
+# Begin asset commands
+def _compress_asset(path: str):
+    """Write gzip and, if available, brotli copies of a file next to it."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    with open(path + '.gz', 'wb') as f:
+        # Fixed mtime for reproducible builds
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+    try:
+        # Brotli is optional, import it here rather than globally
+        import brotli
+
+    except ImportError:
+        click.echo('brotli is not installed, skipping {}.br'.format(path))
+        return
+
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(data, quality=11))
+
+
+@assets_cli.command('build')
+@with_appcontext
+def build_assets():
+    """Build bundles for production.
+
+    Bundles are written to the `dist` directory with a hash of their contents
+    in the name, along with their precompressed (gzip and brotli) versions
+    and the manifest used by templates to find them. Previous builds are
+    removed.
+    """
+    env = current_app.jinja_env.assets_environment
+
+    logger = logging.getLogger('webassets')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+    CommandLineEnvironment(env, logger).build()
+
+    for bundle in env:
+        path = bundle.resolve_output(env)
+        _compress_asset(path)
+
+        # Remove files from previous builds
+        pattern = os.path.join(env.directory, bundle.output % {'version': '*'})
+
+        for old_path in glob.glob(pattern) + glob.glob(pattern + '.*'):
+            if old_path not in (path, path + '.gz', path + '.br'):
+                os.remove(old_path)
+
+        click.echo('Built {}'.format(os.path.relpath(path, env.directory)))
+
+
+# Begin template commands
+@cli.group()
+def templates():
+    """Template commands."""
+    pass
+
+
+@templates.command('compile')
+def compile_templates():
+    """Compile every template to the bytecode cache.
+
+    Production workers load templates from this cache instead of parsing
+    them, so this should be run on every deploy. Templates that change after
+    compiling are detected and parsed again.
+    """
+    cache_dir = current_app.config['TEMPLATES_CACHE_DIR']
+    os.makedirs(cache_dir, exist_ok=True)
+
+    env = current_app.jinja_env
+    env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    env.bytecode_cache.clear()
+
+    # Templates already loaded (e.g. by `WARM_UP`) would be served from
+    # memory and never written to the bytecode cache
+    if env.cache is not None:
+        env.cache.clear()
+
+    start = time.perf_counter()
+    names = env.list_templates()
+
+    for name in names:
+        env.get_template(name)
+
+    click.echo('Compiled {} templates to {} in {:.2f} s'.format(
+        len(names),
+        cache_dir,
+        time.perf_counter() - start
+    ))
+
+
+# Begin database commands
+@db_cli.command('explain')
+@with_appcontext
+def explain_queries():
+    """Show the query plans of the hot queries in the configured database."""
+    dialect = db.engine.dialect
+
+    if dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+
+    else:
+        prefix = 'EXPLAIN '
+
+    connection = db.session.connection()
+
+    for name, query in hot_queries():
+        compiled = query.statement.compile(dialect=dialect)
+
+        if compiled.positional:
+            params = tuple(compiled.params[p] for p in compiled.positiontup)
+
+        else:
+            params = compiled.params
+
+        click.echo('== {}'.format(name))
+        click.echo(str(compiled))
+        click.echo('-- plan:')
+
+        for row in connection.exec_driver_sql(prefix + str(compiled), params):
+            click.echo('    ' + ' | '.join(str(v) for v in row))
+
+        click.echo()
+
+
+# Begin crypto commands
+@cli.group()
+def crypto():
+    """Password hashing commands."""
+    pass
+
+
+def _percentile(values: list, percent: float) -> float:
+    """Obtain the nearest-rank percentile of a list of values."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+
+    return ordered[index]
+
+
+def _time_hash(scheme: str, rounds) -> float:
+    """Hash a random password and return the time it took, in seconds.
+
+    Defined at module level so that it can be run in worker processes.
+    """
+    handler = get_crypt_handler(scheme)
+
+    if rounds is not None:
+        handler = handler.using(rounds=rounds)
+
+    secret = os.urandom(12).hex()
+
+    start = time.perf_counter()
+    handler.hash(secret)
+
+    return time.perf_counter() - start
+
+
+def _measure_hash(scheme: str, rounds, workers: int, samples: int) -> dict:
+    """Measure latency and throughput of a hash with the given cost.
+
+    Args:
+        scheme (str): Name of the passlib hash.
+        rounds: Cost factor, or `None` for schemes without one.
+        workers (int): Number of processes hashing in parallel.
+        samples (int): Total number of hashes to compute.
+
+    Returns:
+        Dict with `rate` (hashes/s), `p50` and `p99` (seconds).
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Warm up every worker before measuring
+        list(executor.map(_time_hash, [scheme] * workers, [rounds] * workers))
+
+        start = time.perf_counter()
+        latencies = list(executor.map(
+            _time_hash,
+            [scheme] * samples,
+            [rounds] * samples
+        ))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'rate': samples / elapsed,
+        'p50': _percentile(latencies, 50),
+        'p99': _percentile(latencies, 99),
+    }
+
+
+def _default_costs(handler) -> list:
+    """Obtain a range of cost factors around the configured one."""
+    current = handler.default_rounds
+
+    if handler.rounds_cost == 'log2':
+        costs = [current - 4, current - 2, current, current + 1]
+
+    else:
+        costs = [current // 4, current // 2, current, current * 2]
+
+    return sorted({
+        min(max(c, handler.min_rounds), handler.max_rounds) for c in costs
+    })
+
+
+def _parse_int_list(value: str) -> list:
+    """Parse a comma-separated list of integers."""
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def _context_handlers() -> list:
+    """Obtain the handlers configured in the crypto manager."""
+    context = crypto_manager._context
+
+    return [context.handler(scheme) for scheme in context.schemes()]
+
+
+@crypto.command('benchmark')
+@click.option('--rounds', help='comma-separated cost factors to test')
+@click.option('--workers', help='comma-separated numbers of parallel workers')
+@click.option('--samples', default=20, show_default=True,
+              help='hashes to compute per measurement')
+def crypto_benchmark(rounds: str, workers: str, samples: int):
+    """Measure the configured password hashes on this machine.
+
+    Every scheme in PASSLIB_SCHEMES is measured for each cost factor and
+    number of parallel workers. By default, a range of cost factors around
+    the configured one is tested with one worker and one worker per CPU.
+    """
+    cpus = os.cpu_count() or 1
+    worker_counts = _parse_int_list(workers) if workers else sorted({1, cpus})
+
+    click.echo('CPUs: {}'.format(cpus))
+    click.echo('{:<16} {:>10} {:>8} {:>12} {:>10} {:>10}'.format(
+        'Scheme', 'Rounds', 'Workers', 'Hashes/s', 'p50 (ms)', 'p99 (ms)'
+    ))
+
+    for handler in _context_handlers():
+        if 'rounds' in handler.setting_kwds:
+            costs = _parse_int_list(rounds) if rounds else _default_costs(handler)
+
+        else:
+            costs = [None]
+
+        for cost in costs:
+            for count in worker_counts:
+                result = _measure_hash(handler.name, cost, count, samples)
+
+                click.echo('{:<16} {:>10} {:>8} {:>12.2f} {:>10.1f} {:>10.1f}'.format(
+                    handler.name,
+                    '-' if cost is None else cost,
+                    count,
+                    result['rate'],
+                    result['p50'] * 1000,
+                    result['p99'] * 1000
+                ))
+
+
+@crypto.command('calibrate')
+@click.option('--target-ms', default=250, show_default=True,
+              help='maximum p99 hash latency (milliseconds)')
+@click.option('--workers', type=int,
+              help='parallel workers during measurement [default: CPUs]')
+@click.option('--samples', default=20, show_default=True,
+              help='hashes to compute per measurement')
+def crypto_calibrate(target_ms: int, workers: int, samples: int):
+    """Propose the cost factor that meets a target login latency.
+
+    Latencies are measured with all workers hashing in parallel, as under
+    load. The proposed values can be set in the configuration file as
+    PASSLIB_ALG_<SCHEME>_ROUNDS.
+    """
+    workers = workers or os.cpu_count() or 1
+    target = target_ms / 1000
+
+    click.echo('Target p99 latency: {} ms with {} workers'.format(target_ms, workers))
+
+    for handler in _context_handlers():
+        if 'rounds' not in handler.setting_kwds:
+            click.echo('{}: no cost factor to calibrate'.format(handler.name))
+            continue
+
+        proposed, result = None, None
+
+        if handler.rounds_cost == 'log2':
+            # Each increment doubles the cost
+            cost = handler.min_rounds
+
+            while cost <= handler.max_rounds:
+                measured = _measure_hash(handler.name, cost, workers, samples)
+
+                if measured['p99'] > target:
+                    break
+
+                proposed, result = cost, measured
+                cost += 1
+
+        else:
+            # Cost is linear, extrapolate from the current value and refine
+            cost = handler.default_rounds
+
+            for _ in range(3):
+                measured = _measure_hash(handler.name, cost, workers, samples)
+
+                if measured['p99'] <= target:
+                    proposed, result = cost, measured
+
+                cost = int(cost * target / measured['p99'])
+                cost = min(max(cost, handler.min_rounds), handler.max_rounds)
+
+        if proposed is None:
+            click.echo('{}: even the minimum cost exceeds the target'.format(handler.name))
+            continue
+
+        click.echo((
+            '{}: rounds={} (currently {}), p50={:.1f} ms, p99={:.1f} ms, '
+            'capacity={:.2f} logins/s'
+        ).format(
+            handler.name,
+            proposed,
+            handler.default_rounds,
+            result['p50'] * 1000,
+            result['p99'] * 1000,
+            result['rate']
+        ))
+        click.echo('    PASSLIB_ALG_{}_ROUNDS = {}'.format(handler.name.upper(), proposed))
+
+
+@crypto.command('report')
+def crypto_report():
+    """Show the distribution of password hashes in the users table.
+
+    Hashes using deprecated schemes or costs are upgraded transparently the
+    next time their users login.
+    """
+    context = crypto_manager._context
+    counts = collections.Counter()
+    outdated = 0
+    total = 0
+
+    query = db.session.query(User.password).yield_per(1000)
+
+    for (password,) in query:
+        total += 1
+
+        try:
+            scheme = context.identify(password)
+            parsed = context.handler(scheme).from_string(password)
+            rounds = getattr(parsed, 'rounds', None)
+
+        except (ValueError, TypeError):
+            scheme, rounds = 'unknown', None
+
+        counts[(scheme, rounds)] += 1
+
+        if scheme == 'unknown' or context.needs_update(password):
+            outdated += 1
+
+    click.echo('{:<16} {:>10} {:>10} {:>8}'.format('Scheme', 'Rounds', 'Users', '%'))
+
+    for (scheme, rounds), count in counts.most_common():
+        click.echo('{:<16} {:>10} {:>10} {:>8.1f}'.format(
+            scheme,
+            '-' if rounds is None else rounds,
+            count,
+            count * 100 / total
+        ))
+
+    click.echo('Total users: {}'.format(total))
+    click.echo('Pending upgrade: {}'.format(outdated))
+
+
+# Begin profiling commands
+# Run in a new interpreter, so that nothing is imported beforehand
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from {package} import init_app
+imported = time.perf_counter()
+app = init_app()
+end = time.perf_counter()
+json.dump({{
+    'import': imported - start,
+    'init': end - imported,
+    'steps': app.extensions['startup_timings'],
+}}, sys.stdout)
+"""
+
+
+def _run_startup() -> tuple:
+    """Start the application in a new interpreter.
+
+    Returns:
+        Tuple with the timings reported by the interpreter and a dict with
+        the self import time (in seconds) of each top-level package.
+    """
+    result = subprocess.run(
+        [
+            sys.executable, '-X', 'importtime', '-c',
+            _STARTUP_SCRIPT.format(package=__package__)
+        ],
+        capture_output=True,
+        check=True,
+        text=True
+    )
+
+    packages = collections.Counter()
+
+    # Lines follow the format "import time: self [us] | cumulative | name"
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_time, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(self_time) / 1e6
+
+    # The application may log or print warnings before the results
+    timings = json.loads(result.stdout[result.stdout.index('{'):])
+
+    return timings, packages
+
+
+@cli.command('profile-startup', with_appcontext=False)
+@click.option('--runs', default=5, show_default=True,
+              help='number of startups to measure (the median is reported)')
+@click.option('--top', default=15, show_default=True,
+              help='number of packages to show, sorted by import time')
+@click.option('--json', 'as_json', is_flag=True,
+              help='output results as JSON (e.g. to track them over time)')
+def profile_startup(runs: int, top: int, as_json: bool):
+    """Report the time taken to import and initialize the application.
+
+    Every run starts a new interpreter that imports the package (with
+    `-X importtime`) and calls `init_app()`, which records the time taken by
+    each of its steps. Import times are attributed to the top-level package
+    of each imported module and include the overhead of `-X importtime`.
+    """
+    results = [_run_startup() for _ in range(runs)]
+
+    report = {
+        'import': statistics.median(r[0]['import'] for r in results),
+        'init': statistics.median(r[0]['init'] for r in results),
+        'steps': {
+            step: statistics.median(r[0]['steps'].get(step, 0) for r in results)
+            for step in results[0][0]['steps']
+        },
+        'packages': dict(collections.Counter({
+            package: statistics.median(r[1].get(package, 0) for r in results)
+            for package in results[0][1]
+        }).most_common(top)),
+    }
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    click.echo('Import: {:.1f} ms'.format(report['import'] * 1000))
+    click.echo('Initialization: {:.1f} ms'.format(report['init'] * 1000))
+
+    click.echo('\n{:<24} {:>10}'.format('Step', 'ms'))
+
+    for step, elapsed in report['steps'].items():
+        click.echo('{:<24} {:>10.2f}'.format(step, elapsed * 1000))
+
+    click.echo('\n{:<24} {:>10}'.format('Package (import)', 'ms'))
+
+    for package, elapsed in report['packages'].items():
+        click.echo('{:<24} {:>10.2f}'.format(package, elapsed * 1000))
+
+
+@cli.group()
+def profile():
+    """Request profiling commands."""
+    pass
+
+
+@profile.command('token')
+def profile_token():
+    """Print a value for the header requesting a profile.
+
+    The value is valid for `PROFILER_HEADER_MAX_AGE` seconds, e.g.:
+
+        curl -H "X-Profile: $(myapp profile token)" https://example.com/
+    """
+    click.echo(profiler.make_token())
+
+
+@profile.command('report')
+@click.option('--endpoint', help='only include requests to this endpoint')
+@click.option('--sort', default='cumulative', show_default=True,
+              type=click.Choice(['cumulative', 'tottime', 'ncalls']),
+              help='order of the functions')
+@click.option('--top', default=30, show_default=True,
+              help='number of functions to show')
+def profile_report(endpoint: str, sort: str, top: int):
+    """Aggregate the profiles of sampled requests.
+
+    Shows the number of profiles and mean time of each endpoint, followed by
+    the functions taking most time across every profile.
+    """
+    paths = sorted(glob.glob(os.path.join(profiler.directory, '*.prof')))
+    samples = collections.defaultdict(list)
+    durations = collections.defaultdict(list)
+
+    for path in paths:
+        try:
+            with open(path[:-len('.prof')] + '.json') as f:
+                metadata = json.load(f)
+
+        except (OSError, ValueError):
+            click.echo('Skipping {}: missing or invalid metadata'.format(path), err=True)
+            continue
+
+        if endpoint and metadata['endpoint'] != endpoint:
+            continue
+
+        name = '{} {}'.format(metadata['method'], metadata['endpoint'])
+        samples[name].append(path)
+        durations[name].append(metadata['duration'])
+
+    if not samples:
+        raise click.ClickException('No profiles found in {}'.format(profiler.directory))
+
+    click.echo('{:<40} {:>8} {:>10}'.format('Endpoint', 'Samples', 'Mean ms'))
+
+    for name, files in sorted(samples.items()):
+        click.echo('{:<40} {:>8} {:>10.1f}'.format(
+            name,
+            len(files),
+            statistics.mean(durations[name]) * 1000
+        ))
+
+    stream = io.StringIO()
+    stats = pstats.Stats(*itertools.chain(*samples.values()), stream=stream)
+
+    # Do not list every file in the header, they are summarized above
+    stats.files = []
+    stats.sort_stats(sort).print_stats(top)
+
+    click.echo('\n' + stream.getvalue().rstrip())
+
+
 if __name__ == '__main__':
     cli()
@@ -4,13 +4,73 @@
 
 import pytz
 
-from flask_babel import lazy_gettext as _l
+from flask_babel import get_locale, lazy_gettext as _l
 from flask_wtf import FlaskForm
 from wtforms import BooleanField, PasswordField, SelectField, \
         StringField, SubmitField
-from wtforms import validators
+from wtforms import validators, widgets
 
 from .bootstrap import LANGUAGES, LANGUAGES_LOCALIZED
+from .helpers import LRUCache
+
+
+# Choices shared by every form instance
+TIMEZONE_CHOICES = [(t, t) for t in pytz.common_timezones]
+TIMEZONES = frozenset(pytz.common_timezones)
+
+
+# Custom fields
+class CachedSelect(widgets.Select):
+    """Select widget that caches the rendered HTML.
+
+    The cache key includes the selected value, the current locale and the
+    render arguments, so this must only be used for fields whose choices do
+    not change between requests.
+
+    Args:
+        size (int): Maximum number of renders to cache.
+    """
+
+    def __init__(self, size: int = 64):
+        super().__init__()
+        self._cache = LRUCache(size=size)
+
+    def __call__(self, field, **kwargs):
+        key = repr((
+            field.name,
+            field.id,
+            field.data,
+            str(get_locale()),
+            sorted(kwargs.items())
+        ))
+
+        html = self._cache.get(key)
+
+        if html is None:
+            html = super().__call__(field, **kwargs)
+            self._cache.set(key, html)
+
+        return html
+
+
+class StaticSelectField(SelectField):
+    """Select field for large lists of choices that never change.
+
+    The field is rendered through `CachedSelect` and the submitted value is
+    validated against a precomputed set instead of iterating the choices.
+
+    Args:
+        values (frozenset): Valid values of the choices.
+    """
+    widget = CachedSelect()
+
+    def __init__(self, label=None, validators=None, values: frozenset = frozenset(), **kwargs):
+        super().__init__(label, validators, **kwargs)
+        self.values = values
+
+    def pre_validate(self, form):
+        if self.data not in self.values:
+            raise validators.ValidationError(self.gettext('Not a valid choice.'))
 
 
 # Authentication forms
@@ -114,10 +174,11 @@ class SignupForm(FlaskForm):
         choices=list(zip(LANGUAGES, LANGUAGES_LOCALIZED))
     )
 
-    timezone = SelectField(
+    timezone = StaticSelectField(
         _l('Timezone'),
-        choices=[(t, t) for t in pytz.common_timezones],
-        default='en'
+        choices=TIMEZONE_CHOICES,
+        values=TIMEZONES,
+        default='UTC'
     )
 
     submit = SubmitField(_l('Submit'))
@@ -2,8 +2,48 @@
 
 """Application helpers."""
 
+import collections
+import contextlib
+import cProfile
+import datetime
+import functools
+import hashlib
+import json
+import mimetypes
+import os
+import queue
+import random
+import re
+import secrets
+import smtplib
+import threading
+import time
+import traceback
+import zlib
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
 from hashids import Hashids
+from itsdangerous import BadSignature, TimestampSigner, URLSafeSerializer
+from flask import Response, abort, before_render_template, current_app, g, \
+    has_request_context, request, send_from_directory, template_rendered
+from flask.json.tag import JSONTag, TaggedJSONSerializer
+from flask_babel import get_locale, lazy_gettext as _l
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
 from passlib.context import CryptContext
+from sqlalchemy import and_, event, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+from webassets import Bundle
+from webassets.filter import Filter
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
+from werkzeug.security import safe_join
+from werkzeug.wsgi import ClosingIterator
 
 
 class CeleryWrapper(object):
@@ -75,10 +115,32 @@ class CryptoManager(object):
     <https://passlib.readthedocs.io/en/stable/lib/passlib.context.html#algorithm-options>).
     These are in the form `PASSLIB_ALG_<SCHEME>_<CONFIG>` and will be translated to the
     appropriate `<scheme>__<config>` configuration variable name internally.
+
+    Hashing may optionally be delegated to a pool of workers so that it can
+    use every core and the number of concurrent hashes is bounded:
+
+    - `PASSLIB_EXECUTOR`: Either `"thread"`, `"process"` or `None` (hash in
+        the calling thread). Defaults to `None`.
+    - `PASSLIB_EXECUTOR_WORKERS`: Number of workers in the pool. Defaults to
+        the number of CPUs.
+    - `PASSLIB_EXECUTOR_QUEUE_SIZE`: Maximum number of pending operations,
+        including those being executed. Further operations raise
+        `HashingQueueFull`. Defaults to four times the number of workers.
+
+    When an executor is configured, `hash()`, `verify()` and
+    `verify_and_update()` wait for the result of the pool, while
+    `hash_async()`, `verify_async()` and `verify_and_update_async()` return a
+    `Future` instead.
     """
 
     def __init__(self):
         self._context = None
+        self._executor = None
+        self._executor_kind = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        self._workers = 1
+        self._slots = None
 
     def __getattr__(self, attr):
         """Wrap the internal passlib context."""
@@ -121,6 +183,259 @@ class CryptoManager(object):
 
         self._context = CryptContext(**params)
 
+        # Executor
+        self._executor_kind = app.config.get('PASSLIB_EXECUTOR')
+
+        if self._executor_kind not in (None, 'thread', 'process'):
+            raise ValueError(
+                'Invalid PASSLIB_EXECUTOR: {}'.format(self._executor_kind)
+            )
+
+        self._workers = app.config.get('PASSLIB_EXECUTOR_WORKERS') or os.cpu_count() or 1
+        queue_size = app.config.get('PASSLIB_EXECUTOR_QUEUE_SIZE') or self._workers * 4
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor = None
+        self._executor_pid = None
+
+    def warm_up(self):
+        """Load the hash backends and start the executor, if configured.
+
+        Backends (e.g. bcrypt) are otherwise loaded, and self-tested, by the
+        first hash or verification. With a process executor, every worker
+        is started and loads its backends as well.
+        """
+        _load_backends(self._context)
+
+        if self._executor_kind is None:
+            return
+
+        executor = self._get_executor()
+
+        if self._executor_kind == 'process':
+            futures = [
+                executor.submit(_run_in_worker, None)
+                for _ in range(self._workers)
+            ]
+
+            for future in futures:
+                future.result()
+
+    def hash(self, secret: str, **kwargs) -> str:
+        """Hash a secret, using the executor if configured."""
+        if self._executor_kind is None:
+            return self._context.hash(secret, **kwargs)
+
+        return self.hash_async(secret, **kwargs).result()
+
+    def verify(self, secret: str, hash: str, **kwargs) -> bool:
+        """Verify a secret against a hash, using the executor if configured."""
+        if self._executor_kind is None:
+            return self._context.verify(secret, hash, **kwargs)
+
+        return self.verify_async(secret, hash, **kwargs).result()
+
+    def verify_and_update(self, secret: str, hash: str, **kwargs) -> tuple:
+        """Verify a secret and obtain a new hash if the current one needs an
+        update, using the executor if configured."""
+        if self._executor_kind is None:
+            return self._context.verify_and_update(secret, hash, **kwargs)
+
+        return self.verify_and_update_async(secret, hash, **kwargs).result()
+
+    def hash_async(self, secret: str, **kwargs) -> Future:
+        """Hash a secret in the executor.
+
+        Returns:
+            `Future` resolving to the hash.
+
+        Raises:
+            `HashingQueueFull` if there are too many pending operations.
+        """
+        return self._submit('hash', secret, **kwargs)
+
+    def verify_async(self, secret: str, hash: str, **kwargs) -> Future:
+        """Verify a secret against a hash in the executor.
+
+        Returns:
+            `Future` resolving to `True` if the secret matches.
+
+        Raises:
+            `HashingQueueFull` if there are too many pending operations.
+        """
+        return self._submit('verify', secret, hash, **kwargs)
+
+    def verify_and_update_async(self, secret: str, hash: str, **kwargs) -> Future:
+        """Verify a secret and obtain an updated hash in the executor.
+
+        Returns:
+            `Future` resolving to a `(verified, new_hash)` tuple.
+
+        Raises:
+            `HashingQueueFull` if there are too many pending operations.
+        """
+        return self._submit('verify_and_update', secret, hash, **kwargs)
+
+    def process_pool(self, workers: Optional[int] = None) -> ProcessPoolExecutor:
+        """Create a process pool able to hash with the current context.
+
+        This is meant for bulk operations (see `hash_many()`) and is
+        independent from the executor configured for requests.
+
+        Args:
+            workers (int): Number of processes. Defaults to the number of CPUs.
+
+        Returns:
+            Process pool, which should be shut down by the caller.
+        """
+        return ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1,
+            initializer=_init_worker_context,
+            initargs=(self._context.to_string(),)
+        )
+
+    def hash_many(self, secrets: list, pool: ProcessPoolExecutor) -> list:
+        """Hash many secrets in parallel.
+
+        Args:
+            secrets (list): Secrets to hash.
+            pool: Process pool obtained through `process_pool()`.
+
+        Returns:
+            List of hashes, in the same order as the secrets.
+        """
+        return list(pool.map(_run_in_worker, ['hash'] * len(secrets), secrets))
+
+    def shutdown(self, wait: bool = True):
+        """Stop the executor of the current process, if any."""
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=wait)
+
+        self._executor = None
+        self._executor_pid = None
+
+    def _submit(self, method: str, *args, **kwargs) -> Future:
+        """Submit a context method to the executor.
+
+        When no executor is configured, the method is executed immediately
+        and a resolved `Future` is returned.
+        """
+        if self._executor_kind is None:
+            future = Future()
+
+            try:
+                future.set_result(getattr(self._context, method)(*args, **kwargs))
+
+            except Exception as e:
+                future.set_exception(e)
+
+            return future
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingQueueFull()
+
+        try:
+            executor = self._get_executor()
+
+            if self._executor_kind == 'process':
+                future = executor.submit(_run_in_worker, method, *args, **kwargs)
+
+            else:
+                future = executor.submit(getattr(self._context, method), *args, **kwargs)
+
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self._slots.release())
+
+        return future
+
+    def _get_executor(self):
+        """Obtain the executor for the current process.
+
+        The executor is created lazily because neither threads nor process
+        pools survive forking, so pre-forking servers need one per worker.
+        """
+        if self._executor_pid == os.getpid():
+            return self._executor
+
+        with self._executor_lock:
+            if self._executor_pid != os.getpid():
+                if self._executor_kind == 'process':
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self._workers,
+                        initializer=_init_worker_context,
+                        initargs=(self._context.to_string(),)
+                    )
+
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self._workers,
+                        thread_name_prefix='crypto'
+                    )
+
+                self._executor_pid = os.getpid()
+
+        return self._executor
+
+
+class HashingQueueFull(ServiceUnavailable):
+    """Raised when the password hashing executor cannot accept more work."""
+
+    description = _l('The server is busy, please try again later.')
+
+
+# Passlib context used by process executor workers
+_worker_context = None
+
+
+def _init_worker_context(config: str):
+    """Create the passlib context in a process executor worker."""
+    global _worker_context
+    _worker_context = CryptContext.from_string(config)
+
+
+def _run_in_worker(method: Optional[str], *args, **kwargs):
+    """Call a passlib context method in a process executor worker.
+
+    If no method is given, the backends of the worker are loaded instead.
+    """
+    if method is None:
+        return _load_backends(_worker_context)
+
+    return getattr(_worker_context, method)(*args, **kwargs)
+
+
+def _load_backends(context: CryptContext):
+    """Load the backends of the handlers in a passlib context."""
+    for scheme in context.schemes():
+        handler = context.handler(scheme)
+
+        if hasattr(handler, 'get_backend'):
+            handler.get_backend()
+
+
+class StartupTimer(object):
+    """Measure the time taken by each step of the application startup.
+
+    Steps are recorded with `mark()` once finished, and their duration is the
+    time elapsed since the previous mark.
+    """
+
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self._last = time.perf_counter()
+
+    def mark(self, step: str):
+        """Record the end of a step.
+
+        Args:
+            step (str): Name of the step.
+        """
+        now = time.perf_counter()
+        self.timings[step] = now - self._last
+        self._last = now
+
 
 class HashidsWrapper(object):
     """Wrapper for deferred initialization of Hashids."""
@@ -143,3 +458,1925 @@ class HashidsWrapper(object):
             length (int): Minimum length the generated hashes will have.
         """
         self._hasher = Hashids(salt=salt, min_length=length)
+
+
+class IconSprite(Filter):
+    """Webassets filter that combines SVG icons into a sprite.
+
+    Every input file is turned into a `<symbol>` identified by the name of the
+    file, so that icons can be referenced as `sprite.svg#name` (see
+    `util.svg_icon()`).
+    """
+
+    name = 'icon_sprite'
+
+    SVG = re.compile(r'<svg[^>]*?viewBox="([^"]+)"[^>]*>(.*)</svg>', re.S)
+    COMMENT = re.compile(r'<!--.*?-->', re.S)
+
+    def input(self, _in, out, source_path: str, **kwargs):
+        """Convert an SVG file to a symbol."""
+        match = self.SVG.search(_in.read())
+
+        if not match:
+            raise ValueError('{} is not a valid SVG icon'.format(source_path))
+
+        view_box, content = match.groups()
+        name = os.path.splitext(os.path.basename(source_path))[0]
+
+        out.write('<symbol id="{}" viewBox="{}">{}</symbol>'.format(
+            name,
+            view_box,
+            self.COMMENT.sub('', content).strip()
+        ))
+
+    def output(self, _in, out, **kwargs):
+        """Wrap the symbols in the sprite."""
+        out.write('<svg xmlns="http://www.w3.org/2000/svg">')
+        out.write(_in.read())
+        out.write('</svg>')
+
+
+# Valid icon names, which are also used to build the path of the icons
+_ICON_NAME = re.compile(r'^[a-z0-9-]+$')
+
+# Arguments of the form macros taking icon names
+_ICON_ARGUMENTS = ('icon', 'label_icon')
+
+
+def find_template_icons(env, template_folder: str) -> list:
+    """Obtain the names of the icons referenced in templates.
+
+    Templates are parsed to find the names given as string literals to
+    `svg_icon()` or to the `icon`/`label_icon` arguments of any call (e.g. the
+    form macros). Names given through variables cannot be found, see
+    `util.svg_icon()`.
+
+    Args:
+        env: Jinja environment used to parse the templates.
+        template_folder (str): Directory containing the templates.
+
+    Returns:
+        Sorted list of icon names.
+    """
+    icons = set()
+
+    for root, _, files in os.walk(template_folder):
+        for filename in files:
+            if not filename.endswith('.html'):
+                continue
+
+            with open(os.path.join(root, filename), encoding='utf-8') as f:
+                tree = env.parse(f.read())
+
+            for call in tree.find_all(nodes.Call):
+                is_icon = isinstance(call.node, nodes.Name) and call.node.name == 'svg_icon'
+                names = call.args[:1] if is_icon else []
+                names += [
+                    kwarg.value for kwarg in call.kwargs
+                    if kwarg.key in _ICON_ARGUMENTS or (is_icon and kwarg.key == 'name')
+                ]
+
+                icons.update(name.value for name in names if isinstance(name, nodes.Const))
+
+    return sorted(
+        icon for icon in icons
+        if isinstance(icon, str) and _ICON_NAME.match(icon)
+    )
+
+
+class IconBundle(Bundle):
+    """Webassets bundle of the SVG sprite (see `IconSprite`).
+
+    Contents are the Font Awesome (solid) icons referenced in templates (see
+    `find_template_icons()`) along with the extra ones given. Templates are
+    only parsed once the contents are needed (e.g. when building the sprite),
+    so that they are not parsed on startup when using a prebuilt one.
+    """
+
+    PATH = 'node_modules/@fortawesome/fontawesome-free/svgs/solid/{}.svg'
+
+    def __init__(self, env, template_folder: str, extra_icons: list = (), **options):
+        """Initialize the bundle.
+
+        Args:
+            env: Jinja environment used to parse the templates.
+            template_folder (str): Directory containing the templates.
+            extra_icons (list): Names of icons not found in templates.
+            options: Remaining bundle options.
+        """
+        self._icons = None
+        self.jinja_env = env
+        self.template_folder = template_folder
+        self.extra_icons = extra_icons
+
+        super().__init__(**options)
+
+    @property
+    def icons(self) -> frozenset:
+        """Names of the icons in the sprite."""
+        if self._icons is None:
+            self._icons = frozenset(
+                find_template_icons(self.jinja_env, self.template_folder)
+            ).union(self.extra_icons)
+
+        return self._icons
+
+    @property
+    def contents(self) -> tuple:
+        return tuple(self.PATH.format(name) for name in sorted(self.icons))
+
+    @contents.setter
+    def contents(self, value):
+        # Contents are always those of the icons
+        self._resolved_contents = None
+
+    @property
+    def is_container(self) -> bool:
+        # Checked before building or finding the URL, which must not resolve
+        # the contents (i.e. parse the templates)
+        return False
+
+
+class ResponseCompressor(object):
+    """Compression of responses for deployments without a reverse proxy.
+
+    Responses are compressed with brotli (if the `brotli` package is
+    installed) or gzip depending on the `Accept-Encoding` header of the
+    request. Streamed responses are compressed chunk by chunk, so they are
+    still delivered incrementally. Static files are not compressed on the fly,
+    but their precompressed versions (`.br` and `.gz` files generated by
+    `myapp assets build`) are served when present.
+
+    The compressor expects the following configuration variables:
+
+    - `COMPRESS_ENABLED`: Whether to compress responses. Defaults to `False`.
+    - `COMPRESS_MIN_SIZE`: Minimum size (in bytes) of the responses to
+        compress. Defaults to `500`.
+    - `COMPRESS_MIMETYPES`: Types of the responses to compress.
+    - `COMPRESS_LEVEL`: Compression level for gzip. Defaults to `6`.
+    - `COMPRESS_BROTLI_QUALITY`: Compression quality for brotli. Defaults to
+        `4`.
+    """
+
+    # File extension of the precompressed files for each encoding
+    EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+    def __init__(self):
+        self.enabled = False
+        self.min_size = 500
+        self.mimetypes = frozenset()
+        self.level = 6
+        self.brotli_quality = 4
+        self._brotli = None
+
+    def init_app(self, app):
+        """Register the compressor in the application.
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('COMPRESS_ENABLED', False)
+
+        if not self.enabled:
+            return
+
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+        self.mimetypes = frozenset(app.config.get('COMPRESS_MIMETYPES', ()))
+        self.level = app.config.get('COMPRESS_LEVEL', 6)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', 4)
+
+        try:
+            # Brotli is optional, import it here rather than globally
+            import brotli
+            self._brotli = brotli
+
+        except ImportError:
+            self._brotli = None
+
+        if 'static' in app.view_functions:
+            app.view_functions['static'] = self._wrap_static(app.view_functions['static'])
+
+        app.after_request(self.compress)
+
+    def _encodings(self) -> list:
+        """Obtain the encodings accepted by the client, by preference."""
+        encodings = []
+
+        if self._brotli is not None and request.accept_encodings['br']:
+            encodings.append('br')
+
+        if request.accept_encodings['gzip']:
+            encodings.append('gzip')
+
+        return encodings
+
+    def _wrap_static(self, view):
+        """Serve precompressed versions of static files if available."""
+        def send_static_file(filename: str):
+            for encoding in self._encodings():
+                path = safe_join(current_app.static_folder, filename + self.EXTENSIONS[encoding])
+
+                if path is None or not os.path.isfile(path):
+                    continue
+
+                # The response keeps the type of the original file and has its
+                # own ETag, which is used for conditional requests
+                response = send_from_directory(
+                    current_app.static_folder,
+                    filename + self.EXTENSIONS[encoding],
+                    mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                    max_age=current_app.get_send_file_max_age(filename)
+                )
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+
+                return response
+
+            return view(filename=filename)
+
+        return send_static_file
+
+    def _compressor(self, encoding: str):
+        """Create a compressor for the given encoding.
+
+        Returns:
+            Tuple with functions to compress (and flush) a chunk of data and
+            to finish the stream.
+        """
+        if encoding == 'br':
+            compressor = self._brotli.Compressor(quality=self.brotli_quality)
+
+            return (
+                lambda data: compressor.process(data) + compressor.flush(),
+                compressor.finish
+            )
+
+        # Gzip container
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+        return (
+            lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush
+        )
+
+    def _compress_stream(self, chunks, encoding: str):
+        """Compress an iterable of chunks as they are produced."""
+        compress, finish = self._compressor(encoding)
+
+        for chunk in chunks:
+            data = compress(chunk)
+
+            if data:
+                yield data
+
+        yield finish()
+
+    def compress(self, response):
+        """Compress a response if the client supports it.
+
+        Args:
+            response: Response of the request.
+
+        Returns:
+            Compressed response.
+        """
+        if response.mimetype not in self.mimetypes:
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        if (
+            response.direct_passthrough
+            or response.status_code not in (200, 201, 202, 203)
+            or 'Content-Encoding' in response.headers
+            or 'Content-Range' in response.headers
+            or response.cache_control.no_transform
+        ):
+            return response
+
+        encodings = self._encodings()
+
+        if not encodings:
+            return response
+
+        encoding = encodings[0]
+
+        if response.is_streamed:
+            original = response.response
+            response.response = ClosingIterator(
+                self._compress_stream(response.iter_encoded(), encoding),
+                getattr(original, 'close', None)
+            )
+            response.headers.pop('Content-Length', None)
+
+        else:
+            data = response.get_data()
+
+            if len(data) < self.min_size:
+                return response
+
+            compress, finish = self._compressor(encoding)
+            response.set_data(compress(data) + finish())
+
+        response.headers['Content-Encoding'] = encoding
+
+        # Compressed representations are not byte-for-byte equal
+        etag, weak = response.get_etag()
+
+        if etag:
+            response.set_etag('{}-{}'.format(etag, encoding), weak)
+
+        return response
+
+
+class LRUCache(object):
+    """Thread-safe in-process LRU cache with per-entry expiration.
+
+    Args:
+        size (int): Maximum number of entries to keep. Least recently used
+            entries are evicted first.
+        ttl (float): Default time to live (in seconds) of the entries. `None`
+            or `0` means entries never expire.
+    """
+
+    def __init__(self, size: int = 1024, ttl: Optional[float] = None):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Obtain a value from the cache.
+
+        Args:
+            key (str): Key of the entry.
+            default: Value to return if the entry is missing or expired.
+
+        Returns:
+            Cached value or `default`.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                return default
+
+            expires, value = entry
+
+            if expires and expires < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value in the cache.
+
+        Args:
+            key (str): Key of the entry.
+            value: Value to store.
+            ttl (float): Time to live for this entry. Defaults to the cache
+                TTL.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        """Remove an entry from the cache, if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+
+class LoginThrottle(object):
+    """Token bucket throttle for login attempts.
+
+    Every attempt consumes a token from two buckets: one for the client
+    address and one for the normalized identity (username or email) being
+    tried. Attempts are rejected while either bucket is empty, which should
+    be checked before querying the database or verifying any hash.
+
+    Buckets are stored as `(tokens, timestamp)` tuples in an in-process
+    `LRUCache` or, optionally, in a shared Redis backend so that limits are
+    enforced across workers and nodes.
+
+    The throttle expects the following configuration variables:
+
+    - `LOGIN_THROTTLE_ENABLED`: Whether to throttle login attempts. Defaults
+        to `True`.
+    - `LOGIN_THROTTLE_IP_BURST` / `LOGIN_THROTTLE_IP_PER_MINUTE`: Maximum
+        consecutive attempts and refill rate for each client address.
+        Default to `20` and `10`.
+    - `LOGIN_THROTTLE_IDENTITY_BURST` / `LOGIN_THROTTLE_IDENTITY_PER_MINUTE`:
+        Maximum consecutive attempts and refill rate for each identity.
+        Default to `5` and `2`.
+    - `LOGIN_THROTTLE_SIZE`: Maximum number of buckets kept in memory per
+        process. Defaults to `65536`.
+    - `CACHE_REDIS_URL`: URL of the Redis server used as shared backend
+        (requires the `redis` package). Defaults to `None`.
+    """
+
+    PREFIX = 'myapp:throttle:'
+
+    # Atomically refill and consume a bucket stored as a Redis hash
+    SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 't', 'ts')
+        local tokens = tonumber(bucket[1]) or capacity
+        local last = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + (now - last) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+        return allowed
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._limits = {}
+        self._local = LRUCache()
+        self._lock = threading.Lock()
+        self._redis = None
+        self._script = None
+
+    def init_app(self, app):
+        """Initialize the throttle.
+
+        Args:
+            app: Application instance
+
+        Raises:
+            `ModuleNotFoundError` in case a shared backend is configured but
+            `redis` is not installed.
+        """
+        self.enabled = app.config.get('LOGIN_THROTTLE_ENABLED', True)
+        self._limits = {
+            'ip': (
+                app.config.get('LOGIN_THROTTLE_IP_BURST', 20),
+                app.config.get('LOGIN_THROTTLE_IP_PER_MINUTE', 10) / 60
+            ),
+            'id': (
+                app.config.get('LOGIN_THROTTLE_IDENTITY_BURST', 5),
+                app.config.get('LOGIN_THROTTLE_IDENTITY_PER_MINUTE', 2) / 60
+            ),
+        }
+        self._local = LRUCache(size=app.config.get('LOGIN_THROTTLE_SIZE', 65536))
+
+        redis_url = app.config.get('CACHE_REDIS_URL')
+
+        if self.enabled and redis_url:
+            # Redis is optional, import it here rather than globally
+            import redis
+
+            self._redis = redis.Redis.from_url(redis_url)
+            self._script = self._redis.register_script(self.SCRIPT)
+
+    def allow(self, address: Optional[str], identity: str) -> bool:
+        """Consume an attempt for the given client and identity.
+
+        Args:
+            address (str): Address of the client.
+            identity (str): Username or email being tried.
+
+        Returns:
+            `True` if the attempt is allowed, otherwise `False`.
+        """
+        if not self.enabled:
+            return True
+
+        identity = (identity or '').strip().casefold()
+
+        # Always consume from both buckets so that rotating one of the keys
+        # does not reset the other
+        allowed_ip = self._consume('ip', address or '')
+        allowed_id = self._consume('id', identity)
+
+        return allowed_ip and allowed_id
+
+    def _consume(self, kind: str, value: str) -> bool:
+        """Refill and consume a token from a bucket."""
+        capacity, rate = self._limits[kind]
+        key = '{}:{}'.format(kind, value)
+        now = time.time()
+
+        if self._redis is not None:
+            return bool(self._script(keys=[self.PREFIX + key], args=[capacity, rate, now]))
+
+        with self._lock:
+            tokens, last = self._local.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+
+            if allowed:
+                tokens -= 1
+
+            # Full buckets are equivalent to missing ones, so expire them
+            self._local.set(key, (tokens, now), ttl=(capacity - tokens) / rate)
+
+        return allowed
+
+
+class MailPool(object):
+    """Pool of persistent SMTP connections for Flask-Mail.
+
+    Opening an SMTP connection (including TLS handshake and authentication)
+    is usually more expensive than sending a message, so connections are
+    kept open and reused by every message sent from the same process,
+    whether from a request or from a Celery worker.
+
+    The pool expects the following configuration variables:
+
+    - `MAIL_POOL_ENABLED`: Whether to reuse connections. When disabled, a new
+        connection is opened for every message. Defaults to `True`.
+    - `MAIL_POOL_SIZE`: Maximum number of connections open at the same time
+        in each process. Defaults to `2`.
+    - `MAIL_POOL_MAX_MESSAGES`: Messages to send through a connection before
+        replacing it. Defaults to `100`.
+    - `MAIL_POOL_IDLE_TIMEOUT`: Seconds a connection may stay unused before it
+        is considered closed by the server and replaced. Defaults to `30`.
+
+    Args:
+        mail: Flask-Mail instance.
+    """
+
+    # Errors after which the connection is considered broken
+    CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+    def __init__(self, mail):
+        self._mail = mail
+        self.enabled = False
+        self.max_messages = 100
+        self.idle_timeout = 30
+        self._size = 2
+        self._idle = None
+        self._slots = None
+        self._pid = None
+        self._pid_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Initialize the pool.
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('MAIL_POOL_ENABLED', True)
+        self.max_messages = app.config.get('MAIL_POOL_MAX_MESSAGES', 100)
+        self.idle_timeout = app.config.get('MAIL_POOL_IDLE_TIMEOUT', 30)
+        self._size = app.config.get('MAIL_POOL_SIZE', 2)
+        self._pid = None
+
+    def send(self, message):
+        """Send a message through a pooled connection.
+
+        If the connection turns out to be closed, the message is retried once
+        through a new connection.
+
+        Args:
+            message: Flask-Mail `Message` instance.
+        """
+        if not self.enabled or current_app.extensions['mail'].suppress:
+            return self._mail.send(message)
+
+        self._ensure_pool()
+        self._slots.acquire()
+
+        try:
+            connection = self._acquire()
+
+            try:
+                message.send(connection)
+
+            except self.CONNECTION_ERRORS:
+                self._close(connection)
+
+                connection = self._open()
+
+                try:
+                    message.send(connection)
+
+                except Exception:
+                    self._close(connection)
+                    raise
+
+            except Exception:
+                self._close(connection)
+                raise
+
+            connection.pool_messages += 1
+            self._release(connection)
+
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close every idle connection of the current process."""
+        if self._pid != os.getpid():
+            return
+
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+
+            except queue.Empty:
+                break
+
+    def _ensure_pool(self):
+        """Create the pool for the current process.
+
+        Sockets must not be shared between forked processes, so each process
+        has its own pool.
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._pid_lock:
+            if self._pid != os.getpid():
+                self._idle = queue.LifoQueue()
+                self._slots = threading.BoundedSemaphore(self._size)
+                self._pid = os.getpid()
+
+    def _acquire(self):
+        """Obtain an open connection, reusing an idle one if possible."""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+
+            except queue.Empty:
+                return self._open()
+
+            if time.monotonic() - connection.pool_last_used <= self.idle_timeout:
+                return connection
+
+            self._close(connection)
+
+    def _release(self, connection):
+        """Return a connection to the pool, or close it if exhausted."""
+        if connection.pool_messages >= self.max_messages:
+            self._close(connection)
+            return
+
+        connection.pool_last_used = time.monotonic()
+        self._idle.put(connection)
+
+    def _open(self):
+        """Open a new connection."""
+        connection = self._mail.connect().__enter__()
+        connection.pool_messages = 0
+        connection.pool_last_used = time.monotonic()
+
+        return connection
+
+    def _close(self, connection):
+        """Close a connection, ignoring errors as it may already be closed."""
+        try:
+            connection.__exit__(None, None, None)
+
+        except Exception:
+            pass
+
+
+class _TagISODateTime(JSONTag):
+    """Serialize datetimes keeping microseconds, unlike the default tag."""
+
+    key = ' dti'
+
+    def check(self, value: Any) -> bool:
+        return isinstance(value, datetime.datetime)
+
+    def to_json(self, value: datetime.datetime) -> str:
+        return value.isoformat()
+
+    def to_python(self, value: str) -> datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+
+
+class PrincipalCache(object):
+    """Cache for the users loaded by Flask-Login on every request.
+
+    Entries are stored per user ID together with the session serial they were
+    loaded for, so that a lookup for an `ID_serial` identifier only succeeds
+    while the serial is still the current one. Entries are kept in an
+    in-process `LRUCache` and in a shared Redis backend, as JSON. Invalidations
+    are broadcast through Redis pub/sub so that every worker (and node) drops
+    its local copy.
+
+    Every user also has a version, incremented when invalidating it. It must
+    be obtained with `version()` before loading the user from the database
+    and passed to `set()`, which discards the entry if the user was
+    invalidated in the meantime. Otherwise, a request that loaded the user
+    right before a change was committed could cache the old values again.
+
+    The cache expects the following configuration variables:
+
+    - `USER_CACHE_ENABLED`: Whether to cache users. Defaults to `None`, which
+        enables the cache only with a shared backend. Without one, changes
+        performed from another process (e.g. another worker or the CLI), such
+        as deactivating a user, may take `USER_CACHE_TTL` seconds to be
+        noticed.
+    - `USER_CACHE_SIZE`: Maximum number of users kept in memory per process.
+        Defaults to `1024`.
+    - `USER_CACHE_TTL`: Time (in seconds) an entry is considered valid, which
+        bounds how long a missed invalidation goes unnoticed. Defaults to
+        `15`.
+    - `CACHE_REDIS_URL`: URL of the Redis server used as shared backend
+        (requires the `redis` package). Defaults to `None`.
+    """
+
+    CHANNEL = 'myapp:users:invalidate'
+    PREFIX = 'myapp:users:'
+    VERSION_PREFIX = 'myapp:users:version:'
+
+    # Versions only need to outlive the requests loading users
+    VERSION_TTL = 24 * 60 * 60
+
+    # Stores an entry only if the version of the user did not change
+    SET_SCRIPT = """
+        if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+            return 0
+        end
+        if ARGV[3] == '0' then
+            redis.call('SET', KEYS[2], ARGV[2])
+        else
+            redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+        end
+        return 1
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.ttl = 0
+        self._local = LRUCache()
+        # One counter per invalidated user, kept for the life of the process
+        self._versions = collections.Counter()
+        self._versions_lock = threading.Lock()
+        self._redis = None
+        self._set_script = None
+        self._serializer = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Initialize the cache.
+
+        Args:
+            app: Application instance
+
+        Raises:
+            `ModuleNotFoundError` in case a shared backend is configured but
+            `redis` is not installed.
+        """
+        redis_url = app.config.get('CACHE_REDIS_URL')
+
+        self.enabled = app.config.get('USER_CACHE_ENABLED')
+
+        if self.enabled is None:
+            self.enabled = bool(redis_url)
+
+        self.ttl = app.config.get('USER_CACHE_TTL', 15)
+        self._local = LRUCache(
+            size=app.config.get('USER_CACHE_SIZE', 1024),
+            ttl=self.ttl
+        )
+
+        if self.enabled and redis_url:
+            # Redis is optional, import it here rather than globally
+            import redis
+
+            self._redis = redis.Redis.from_url(redis_url)
+            self._set_script = self._redis.register_script(self.SET_SCRIPT)
+            self._serializer = TaggedJSONSerializer()
+            self._serializer.register(_TagISODateTime, index=0)
+
+    def get(self, uid: str, serial: str) -> Optional[dict]:
+        """Obtain the cached attributes of a user.
+
+        Args:
+            uid (str): ID of the user.
+            serial (str): Session serial the user must currently have.
+
+        Returns:
+            Dict of cached attributes or `None` if not found.
+        """
+        if not self.enabled:
+            return None
+
+        entry = self._local.get(uid)
+
+        if entry is None and self._redis is not None:
+            self._ensure_listener()
+            raw = self._redis.get(self.PREFIX + uid)
+
+            if raw is not None:
+                entry = self._serializer.loads(raw)
+                self._local.set(uid, entry)
+
+        if entry is None or entry['serial'] != serial:
+            return None
+
+        return entry['data']
+
+    def version(self, uid: str) -> int:
+        """Obtain the current version of a user.
+
+        Args:
+            uid (str): ID of the user.
+
+        Returns:
+            Version to pass to `set()`.
+        """
+        if not self.enabled:
+            return 0
+
+        if self._redis is not None:
+            return int(self._redis.get(self.VERSION_PREFIX + uid) or 0)
+
+        with self._versions_lock:
+            return self._versions[uid]
+
+    def set(self, uid: str, serial: str, data: dict, version: int):
+        """Store the attributes of a user, unless invalidated since loaded.
+
+        Args:
+            uid (str): ID of the user.
+            serial (str): Current session serial of the user.
+            data (dict): Attributes to cache.
+            version (int): Version of the user obtained with `version()`
+                before loading it.
+        """
+        if not self.enabled:
+            return
+
+        entry = {'serial': serial, 'data': data}
+
+        if self._redis is not None:
+            self._ensure_listener()
+
+            stored = self._set_script(
+                keys=[self.VERSION_PREFIX + uid, self.PREFIX + uid],
+                args=[version, self._serializer.dumps(entry), self.ttl or 0]
+            )
+
+            if stored:
+                self._local.set(uid, entry)
+
+            return
+
+        with self._versions_lock:
+            if self._versions[uid] == version:
+                self._local.set(uid, entry)
+
+    def invalidate(self, *uids: str):
+        """Remove users from the cache in every process.
+
+        Args:
+            uids (str): IDs of the users to remove.
+        """
+        if not self.enabled or not uids:
+            return
+
+        self._drop(uids)
+
+        if self._redis is not None:
+            pipeline = self._redis.pipeline()
+
+            for uid in uids:
+                pipeline.incr(self.VERSION_PREFIX + uid)
+                pipeline.expire(self.VERSION_PREFIX + uid, self.VERSION_TTL)
+
+            pipeline.delete(*[self.PREFIX + uid for uid in uids])
+            pipeline.publish(self.CHANNEL, ','.join(uids))
+            pipeline.execute()
+
+    def _drop(self, uids):
+        """Remove local entries and increment their local versions."""
+        with self._versions_lock:
+            for uid in uids:
+                self._versions[uid] += 1
+                self._local.delete(uid)
+
+    def _ensure_listener(self):
+        """Start the invalidation listener for the current process.
+
+        This is done lazily because threads do not survive forking, so
+        pre-forking servers need one listener per worker.
+        """
+        if self._listener_pid == os.getpid():
+            return
+
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+            self._listener_pid = os.getpid()
+
+    def _on_invalidate(self, message: dict):
+        """Drop local entries announced by another process."""
+        self._drop(message['data'].decode().split(','))
+
+
+class FragmentCache(object):
+    """Cache for rendered fragments of templates and views.
+
+    Fragments are stored under a name and keyed by the endpoint, view
+    arguments, query arguments and locale of the request, as well as the
+    current user (unless disabled per fragment). They are kept in an
+    in-process `LRUCache` or, if configured, in a shared Redis backend.
+
+    Every name has a generation which is incremented when invalidating it,
+    so that all the fragments cached under that name are discarded at once
+    without having to find them. Note that generations are kept per process
+    when there is no shared backend, in which case invalidations performed
+    in a different process are only noticed after the fragments expire.
+
+    Fragments can be cached in templates with the `{% cache %}` tag:
+
+        {% cache 'user_list', ttl=60 %}
+            ...
+        {% endcache %}
+
+    Or in views returning a string with the `cached()` decorator. In both
+    cases, fragments must not contain CSRF tokens or flashed messages, as
+    these change on every request.
+
+    The cache expects the following configuration variables:
+
+    - `FRAGMENT_CACHE_ENABLED`: Whether to cache fragments. When disabled,
+        fragments are always rendered. Defaults to `True`.
+    - `FRAGMENT_CACHE_SIZE`: Maximum number of fragments kept in memory per
+        process. Defaults to `1024`.
+    - `FRAGMENT_CACHE_TTL`: Default time (in seconds) a fragment is
+        considered valid. Defaults to `300`.
+    - `CACHE_REDIS_URL`: URL of the Redis server used as shared backend
+        (requires the `redis` package). Defaults to `None`, which disables the
+        shared backend.
+    """
+
+    PREFIX = 'myapp:fragments:'
+
+    def __init__(self):
+        self.enabled = False
+        self.ttl = 300
+        self._local = LRUCache()
+        self._generations = collections.Counter()
+        self._redis = None
+
+    def init_app(self, app):
+        """Initialize the cache and register the `{% cache %}` template tag.
+
+        Args:
+            app: Application instance
+
+        Raises:
+            `ModuleNotFoundError` in case a shared backend is configured but
+            `redis` is not installed.
+        """
+        self.enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', 300)
+        self._local = LRUCache(
+            size=app.config.get('FRAGMENT_CACHE_SIZE', 1024),
+            ttl=self.ttl
+        )
+
+        redis_url = app.config.get('CACHE_REDIS_URL')
+
+        if self.enabled and redis_url:
+            # Redis is optional, import it here rather than globally
+            import redis
+
+            self._redis = redis.Redis.from_url(redis_url)
+
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+
+    def make_key(self, name: str, per_user: bool = True, vary: Any = None) -> str:
+        """Build the key of a fragment for the current request.
+
+        Args:
+            name (str): Name of the fragment.
+            per_user (bool): Whether the fragment differs for each user.
+            vary: Additional (hashable) value the fragment depends on.
+
+        Returns:
+            Key of the fragment.
+        """
+        parts = [str(get_locale()), vary]
+
+        if has_request_context():
+            parts += [
+                request.endpoint,
+                sorted((request.view_args or {}).items()),
+                sorted(request.args.items(multi=True)),
+                request.headers.get('X-WITH-AJAX'),
+            ]
+
+            if per_user:
+                parts.append(current_user.get_id())
+
+        digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+
+        return '{}{}:{}'.format(self.PREFIX, name, digest)
+
+    def get(self, name: str, key: str):
+        """Obtain a fragment.
+
+        Args:
+            name (str): Name of the fragment.
+            key (str): Key of the fragment, see `make_key()`.
+
+        Returns:
+            Tuple with the current generation of the name and the cached
+            fragment (or `None` if missing or invalidated).
+        """
+        if self._redis is not None:
+            raw, generation = self._redis.mget(key, self.PREFIX + name)
+            generation = int(generation or 0)
+            entry = json.loads(raw) if raw is not None else None
+
+        else:
+            generation = self._generations[name]
+            entry = self._local.get(key)
+
+        if entry is None or entry[0] != generation:
+            return generation, None
+
+        return generation, entry[1]
+
+    def set(self, key: str, generation: int, content: str, ttl: Optional[float] = None):
+        """Store a fragment.
+
+        Args:
+            key (str): Key of the fragment, see `make_key()`.
+            generation (int): Generation of the name when the fragment started
+                rendering, as returned by `get()`.
+            content (str): Rendered fragment.
+            ttl (float): Time to live of the fragment. Defaults to
+                `FRAGMENT_CACHE_TTL`.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        entry = (generation, str(content))
+
+        if self._redis is not None:
+            # JSON rather than pickle, so that whoever can write to the backend
+            # cannot run code in the workers
+            self._redis.set(key, json.dumps(entry), ex=ttl or None)
+
+        else:
+            self._local.set(key, entry, ttl)
+
+    def invalidate(self, *names: str):
+        """Discard all the fragments cached under the given names.
+
+        This should be called after committing the changes that affect the
+        fragments, as otherwise concurrent requests may cache them again with
+        outdated data.
+
+        Args:
+            names (str): Names of the fragments.
+        """
+        for name in names:
+            if self._redis is not None:
+                self._redis.incr(self.PREFIX + name)
+
+            else:
+                self._generations[name] += 1
+
+    def fragment(self, name: str, render: Callable[[], str], ttl: Optional[float] = None,
+                 per_user: bool = True, vary: Any = None) -> str:
+        """Obtain a fragment, rendering and caching it if needed.
+
+        Args:
+            name (str): Name of the fragment.
+            render: Function returning the rendered fragment.
+            ttl (float): Time to live of the fragment.
+            per_user (bool): Whether the fragment differs for each user.
+            vary: Additional value the fragment depends on.
+
+        Returns:
+            Rendered fragment.
+        """
+        if not self.enabled:
+            return render()
+
+        key = self.make_key(name, per_user, vary)
+        generation, content = self.get(name, key)
+
+        if content is None:
+            content = render()
+            self.set(key, generation, content, ttl)
+
+        return content
+
+    def cached(self, name: Optional[str] = None, ttl: Optional[float] = None,
+               per_user: bool = True):
+        """Decorator to cache the output of a view.
+
+        Only `GET` requests are cached, and only when the view returns a
+        string (e.g. the result of `render_template()`), so views may still
+        return redirects or other responses.
+
+        Args:
+            name (str): Name of the fragment. Defaults to the endpoint.
+            ttl (float): Time to live of the fragment.
+            per_user (bool): Whether the output differs for each user.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method != 'GET':
+                    return view(*args, **kwargs)
+
+                fragment_name = name or request.endpoint
+                key = self.make_key(fragment_name, per_user)
+                generation, content = self.get(fragment_name, key)
+
+                if content is not None:
+                    return content
+
+                rv = view(*args, **kwargs)
+
+                if isinstance(rv, str):
+                    self.set(key, generation, rv, ttl)
+
+                return rv
+
+            return wrapper
+
+        return decorator
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension providing the `{% cache %}` tag of `FragmentCache`.
+
+    The tag receives the name of the fragment followed by any keyword
+    argument accepted by `FragmentCache.fragment()`:
+
+        {% cache 'sidebar', ttl=60, per_user=False %}...{% endcache %}
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        kwargs = []
+
+        while parser.stream.skip_if('comma'):
+            key = parser.stream.expect('name').value
+            parser.stream.expect('assign')
+            kwargs.append(nodes.Keyword(key, parser.parse_expression()))
+
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', args, kwargs),
+            [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, name: str, caller, **kwargs) -> Markup:
+        return Markup(self.environment.fragment_cache.fragment(name, caller, **kwargs))
+
+
+class KeysetPagination(object):
+    """Keyset (seek) pagination of a query.
+
+    Instead of skipping rows with `OFFSET`, pages are located by filtering the
+    rows that come after (or before) the last row of the previous page,
+    according to the ordering key. Given an index on the key, every page
+    costs the same regardless of its position. Total counts are not
+    computed, so only links to the previous and next pages are available.
+
+    The key must uniquely identify rows (e.g. ending with the primary key) and
+    is given as a list of columns, which may be descending:
+
+        KeysetPagination(query, [User.joined_at.desc(), User.id.desc()], 10)
+
+    Cursors are opaque (and signed) strings containing the key of the first
+    or last row of the page.
+
+    Args:
+        query: SQLAlchemy ORM query to paginate, without ordering.
+        key (list): Columns of the ordering key.
+        per_page (int): Number of items per page.
+        after (str): Cursor of the row after which the page starts.
+        before (str): Cursor of the row before which the page ends.
+        secret_key (str): Key used to sign cursors. Defaults to the
+            `SECRET_KEY` of the application.
+
+    Raises:
+        `itsdangerous.BadSignature` in case a cursor is not valid.
+    """
+
+    SALT = 'keyset-pagination'
+
+    def __init__(self, query, key: list, per_page: int, after: Optional[str] = None,
+                 before: Optional[str] = None, secret_key: Optional[str] = None):
+        self.per_page = per_page
+        serializer = TaggedJSONSerializer()
+        serializer.register(_TagISODateTime, index=0)
+
+        self._serializer = URLSafeSerializer(
+            secret_key or current_app.config['SECRET_KEY'],
+            salt=self.SALT,
+            serializer=serializer
+        )
+
+        # Column and whether it is descending
+        self._key = [
+            (col.element, col.modifier is operators.desc_op)
+            if isinstance(col, UnaryExpression) else (col, False)
+            for col in key
+        ]
+
+        backwards = after is None and before is not None
+        cursor = before if backwards else after
+
+        if cursor is not None:
+            query = query.filter(self._seek(self._serializer.loads(cursor), backwards))
+
+        # Backward pages are obtained in reverse order and flipped afterwards
+        query = query.order_by(*[
+            col.desc() if desc != backwards else col.asc()
+            for col, desc in self._key
+        ])
+
+        # Fetch an additional row to know whether there are more pages
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+
+        if backwards:
+            items.reverse()
+            self.has_prev, self.has_next = more, True
+
+        else:
+            self.has_prev, self.has_next = cursor is not None, more
+
+        self.items = items
+
+    def _seek(self, values: list, backwards: bool):
+        """Build the condition for rows following the given key values.
+
+        Equivalent to a row value comparison such as `(a, b) > (1, 2)`, but
+        supporting mixed directions: `a > 1 OR (a = 1 AND b > 2)`. The first
+        column is also compared on its own so that its index can be used.
+        """
+        clauses = []
+
+        for i, (col, desc) in enumerate(self._key):
+            op = operators.lt if desc != backwards else operators.gt
+            clauses.append(and_(
+                *[prev == value for (prev, _), value in zip(self._key[:i], values)],
+                op(col, values[i])
+            ))
+
+        first, desc = self._key[0]
+        op = operators.le if desc != backwards else operators.ge
+
+        return and_(op(first, values[0]), or_(*clauses))
+
+    def _cursor(self, item) -> str:
+        return self._serializer.dumps([getattr(item, col.key) for col, _ in self._key])
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        """Cursor of the next page, if any."""
+        if not self.has_next or not self.items:
+            return None
+
+        return self._cursor(self.items[-1])
+
+    @property
+    def prev_cursor(self) -> Optional[str]:
+        """Cursor of the previous page, if any."""
+        if not self.has_prev or not self.items:
+            return None
+
+        return self._cursor(self.items[0])
+
+
+class Metrics(object):
+    """Instrumentation of requests.
+
+    The time spent by every request in database queries (SQLAlchemy engine
+    events), rendering templates (Flask signals) and in instrumented methods
+    (see `instrument()`, e.g. password hashing or sending emails) is
+    accounted separately. This is reported in a `Server-Timing` header, which
+    browsers show in their developer tools, and recorded as Prometheus
+    metrics: request latency and the time taken by each component per
+    endpoint, as well as the number of queries per request.
+
+    Timings only include the `before_request` and `after_request` functions
+    registered after the metrics, so `init_app()` should be called before
+    setting up other extensions.
+
+    Prometheus metrics are exposed in text format at an internal endpoint.
+    Each worker of a pre-forking server keeps its own metrics, so a directory
+    shared by all of them must be configured in order to aggregate their
+    values (see the multiprocess mode of `prometheus_client`).
+
+    The instrumentation expects the following configuration variables:
+
+    - `METRICS_ENABLED`: Whether to record Prometheus metrics (requires the
+        `prometheus_client` package). Defaults to `False`.
+    - `METRICS_ENDPOINT`: Path of the metrics endpoint. Defaults to
+        `/metrics`.
+    - `METRICS_ALLOWED_ADDRESSES`: Client addresses allowed to fetch the
+        metrics. Defaults to localhost.
+    - `METRICS_DIR`: Directory where workers store their metrics, which must
+        be emptied whenever the server is restarted. Defaults to `None`, in
+        which case only the metrics of the worker serving the request are
+        exposed.
+    - `METRICS_SERVER_TIMING`: Whether to add the `Server-Timing` header.
+        Defaults to `None`, which adds it outside production.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.server_timing = False
+        self.endpoint = '/metrics'
+        self.allowed_addresses = frozenset()
+        self._metrics = None
+        self._registry = None
+
+    def init_app(self, app):
+        """Register the instrumentation in the application.
+
+        Args:
+            app: Application instance
+
+        Raises:
+            `ModuleNotFoundError` in case metrics are enabled but
+            `prometheus_client` is not installed.
+        """
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        self.server_timing = app.config.get('METRICS_SERVER_TIMING')
+
+        if self.server_timing is None:
+            self.server_timing = app.config['ENV'] != 'production'
+
+        if not self.enabled and not self.server_timing:
+            return
+
+        _listen_queries(_record_query_timing)
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+
+        app.before_request(_start_request_timing)
+        app.after_request(self._finish_request)
+
+        if self.enabled:
+            self._setup_prometheus(app)
+
+    def _setup_prometheus(self, app):
+        """Create the metrics and register their endpoint."""
+        metrics_dir = app.config.get('METRICS_DIR')
+
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+            # Read by the client when imported
+            os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+
+        # prometheus_client is optional, import it here rather than globally
+        import prometheus_client
+
+        if metrics_dir:
+            from prometheus_client import multiprocess
+
+            self._registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(self._registry)
+
+        else:
+            self._registry = prometheus_client.REGISTRY
+
+        # Metrics are registered globally, so only create them once
+        if self._metrics is None:
+            self._metrics = {
+                'requests': prometheus_client.Counter(
+                    'myapp_requests_total',
+                    'Requests served',
+                    ['endpoint', 'method', 'status']
+                ),
+                'latency': prometheus_client.Histogram(
+                    'myapp_request_duration_seconds',
+                    'Time taken to serve requests',
+                    ['endpoint']
+                ),
+                'components': prometheus_client.Histogram(
+                    'myapp_request_component_seconds',
+                    'Time spent by requests in each component',
+                    ['endpoint', 'component']
+                ),
+                'queries': prometheus_client.Histogram(
+                    'myapp_request_queries',
+                    'Database queries executed by requests',
+                    ['endpoint'],
+                    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, float('inf'))
+                ),
+            }
+
+        self.endpoint = app.config.get('METRICS_ENDPOINT', '/metrics')
+        self.allowed_addresses = frozenset(
+            app.config.get('METRICS_ALLOWED_ADDRESSES', ('127.0.0.1', '::1'))
+        )
+
+        app.add_url_rule(self.endpoint, 'metrics', self._expose)
+
+    def instrument(self, obj, *names: str, component: str):
+        """Account the time spent in methods of an object to a component.
+
+        Args:
+            obj: Object whose methods to instrument (e.g. an extension).
+            names (str): Names of the methods.
+            component (str): Name of the component (e.g. `crypto`).
+        """
+        if not self.enabled and not self.server_timing:
+            return
+
+        for name in names:
+            method = getattr(obj, name)
+
+            # Objects are usually global and may be instrumented more than once
+            if not getattr(method, 'instrumented', False):
+                setattr(obj, name, _timed(component, method))
+
+    def _finish_request(self, response):
+        """Report and record the timings of the request."""
+        timings = g.pop('request_timings', None)
+
+        if timings is None:
+            return response
+
+        total = time.perf_counter() - g.pop('request_start')
+
+        if self.server_timing:
+            response.headers['Server-Timing'] = ', '.join([
+                '{};dur={:.1f};desc="{} calls"'.format(component, elapsed * 1000, count)
+                for component, (count, elapsed) in timings.items()
+            ] + ['total;dur={:.1f}'.format(total * 1000)])
+
+        if self._metrics is not None and request.endpoint != 'metrics':
+            endpoint = request.endpoint or 'none'
+
+            self._metrics['requests'].labels(
+                endpoint,
+                request.method,
+                response.status_code
+            ).inc()
+            self._metrics['latency'].labels(endpoint).observe(total)
+            self._metrics['queries'].labels(endpoint).observe(
+                timings['db'][0] if 'db' in timings else 0
+            )
+
+            for component, (_, elapsed) in timings.items():
+                self._metrics['components'].labels(endpoint, component).observe(elapsed)
+
+        return response
+
+    def _expose(self):
+        """Metrics in Prometheus text format."""
+        if request.remote_addr not in self.allowed_addresses:
+            abort(404)
+
+        # prometheus_client is optional, import it here rather than globally
+        import prometheus_client
+
+        return Response(
+            prometheus_client.generate_latest(self._registry),
+            content_type=prometheus_client.CONTENT_TYPE_LATEST
+        )
+
+
+def _start_request_timing():
+    """Prepare the accounting of the request."""
+    g.request_start = time.perf_counter()
+    g.request_timings = collections.defaultdict(lambda: [0, 0.0])
+
+
+def _record_timing(component: str, elapsed: float):
+    """Account time spent by the current request in a component."""
+    if not has_request_context():
+        return
+
+    timings = g.get('request_timings')
+
+    if timings is not None:
+        entry = timings[component]
+        entry[0] += 1
+        entry[1] += elapsed
+
+
+def _timed(component: str, func: Callable) -> Callable:
+    """Wrap a function to account its time to a component."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+
+        finally:
+            _record_timing(component, time.perf_counter() - start)
+
+    wrapper.instrumented = True
+
+    return wrapper
+
+
+def _record_query_timing(statement: str, elapsed: float):
+    _record_timing('db', elapsed)
+
+
+def _before_render_template(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('render_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    if has_request_context() and g.get('render_starts'):
+        _record_timing('template', time.perf_counter() - g.render_starts.pop())
+
+
+# Functions called with the statement and duration of every query
+_query_listeners = []
+
+
+def _listen_queries(listener: Callable):
+    """Call a function after executing each database query.
+
+    The function receives the statement and the time it took to execute.
+
+    Args:
+        listener (Callable): Function to call.
+    """
+    # Engine events apply to every engine and must only be registered once
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    if listener not in _query_listeners:
+        _query_listeners.append(listener)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None or not hasattr(context, 'query_start'):
+        return
+
+    elapsed = time.perf_counter() - context.query_start
+
+    for listener in _query_listeners:
+        listener(statement, elapsed)
+
+
+class QueryMonitor(object):
+    """Detection of slow and repeated database queries.
+
+    Queries taking longer than a threshold are logged along with the endpoint
+    and the application code that executed them. Within a request, executing
+    the same statement (regardless of its parameters) several times is
+    reported as well, as it usually means that a relationship is lazy-loaded
+    for each item of a list (N+1 queries) and should be loaded with the list
+    instead (e.g. with `joinedload()`).
+
+    `budget()` can be used regardless of the configuration to check the
+    number of queries executed by a block of code in tests.
+
+    The monitor expects the following configuration variables:
+
+    - `QUERY_MONITOR_ENABLED`: Whether to monitor queries. Defaults to
+        `None`, which enables it outside production.
+    - `QUERY_MONITOR_SLOW_THRESHOLD`: Time (in seconds) above which queries
+        are logged. Defaults to 0.5 seconds.
+    - `QUERY_MONITOR_REPEATED_THRESHOLD`: Number of executions of a statement
+        within a request above which it is reported. Defaults to 5.
+    - `QUERY_MONITOR_STACK_DEPTH`: Number of frames of the application code
+        to include in the logs. Defaults to 5.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = None
+        self.repeated_threshold = None
+        self.stack_depth = 5
+        self._logger = None
+        self._root_path = None
+
+    def init_app(self, app):
+        """Start monitoring queries if enabled.
+
+        Args:
+            app: Application instance
+        """
+        self.enabled = app.config.get('QUERY_MONITOR_ENABLED')
+
+        if self.enabled is None:
+            self.enabled = app.config['ENV'] != 'production'
+
+        if not self.enabled:
+            return
+
+        self.slow_threshold = app.config.get('QUERY_MONITOR_SLOW_THRESHOLD', 0.5)
+        self.repeated_threshold = app.config.get('QUERY_MONITOR_REPEATED_THRESHOLD', 5)
+        self.stack_depth = app.config.get('QUERY_MONITOR_STACK_DEPTH', 5)
+        self._logger = app.logger
+        self._root_path = app.root_path
+
+        _listen_queries(self._check_query)
+
+    def _check_query(self, statement: str, elapsed: float):
+        """Report the query if slow or repeated within the request."""
+        if self.slow_threshold is not None and elapsed > self.slow_threshold:
+            self._logger.warning(
+                'Slow query (%.3f s) in %s:\n%s\n%s',
+                elapsed,
+                self._location(),
+                statement,
+                self._stack()
+            )
+
+        if self.repeated_threshold is None or not has_request_context():
+            return
+
+        counts = g.get('query_counts')
+
+        if counts is None:
+            counts = g.query_counts = collections.Counter()
+
+        counts[statement] += 1
+
+        # Only report each statement once per request
+        if counts[statement] == self.repeated_threshold + 1:
+            self._logger.warning(
+                'Query executed more than %d times (possible N+1 queries) in %s:\n%s\n%s',
+                self.repeated_threshold,
+                self._location(),
+                statement,
+                self._stack()
+            )
+
+    def _location(self) -> str:
+        """Description of the request executing queries."""
+        if not has_request_context():
+            return 'no request'
+
+        return '%s %s (%s)' % (request.method, request.path, request.endpoint)
+
+    def _stack(self) -> str:
+        """Most recent frames of the application code."""
+        frames = [
+            frame for frame in traceback.extract_stack()
+            if frame.filename.startswith(self._root_path)
+            and frame.filename != __file__
+        ]
+
+        return ''.join(traceback.format_list(frames[-self.stack_depth:]))
+
+    @contextlib.contextmanager
+    def budget(self, max_queries: int):
+        """Check the number of queries executed by a block of code.
+
+        Only queries executed by the current thread are counted, e.g.:
+
+            with query_monitor.budget(3):
+                client.get('/invite')
+
+        Args:
+            max_queries (int): Maximum number of queries allowed.
+
+        Raises:
+            `AssertionError` when exceeding the budget, listing the statements
+            executed.
+        """
+        thread_id = threading.get_ident()
+        statements = []
+
+        def count(statement: str, elapsed: float):
+            if threading.get_ident() == thread_id:
+                statements.append(statement)
+
+        _listen_queries(count)
+
+        try:
+            yield statements
+
+        finally:
+            _query_listeners.remove(count)
+
+        if len(statements) > max_queries:
+            raise AssertionError(
+                '%d queries executed, expected at most %d:\n%s' % (
+                    len(statements),
+                    max_queries,
+                    '\n'.join(statements)
+                )
+            )
+
+
+class RequestProfiler(object):
+    """Profiling of sampled requests in production.
+
+    Wraps the WSGI application to run a random fraction of the requests, as
+    well as those including a signed header (see `make_token()`), under
+    `cProfile`. Each profile is stored in the `pstats` format (`.prof`), next
+    to a JSON file (`.json`) with the method, endpoint, path and duration of
+    the request. Profiles can be aggregated with `myapp profile report` or
+    opened with any tool supporting the format (e.g. `snakeviz`).
+
+    The response of a profiled request is buffered, which prevents streaming
+    it.
+
+    The profiler expects the following configuration variables:
+
+    - `PROFILER_ENABLED`: Whether to profile requests. Defaults to `False`.
+    - `PROFILER_DIR`: Directory where profiles are stored. Defaults to
+        `profiles` in the instance folder.
+    - `PROFILER_SAMPLE_RATE`: Fraction of the requests to profile. Defaults
+        to 0 (only requests with the header are profiled).
+    - `PROFILER_HEADER`: Name of the header requesting a profile. Defaults to
+        `X-Profile`.
+    - `PROFILER_HEADER_MAX_AGE`: Time (in seconds) a header value is valid.
+        Defaults to 1 hour.
+    - `PROFILER_MAX_FILES`: Maximum number of profiles in the directory, no
+        more requests are profiled once reached. Defaults to 1000.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.sample_rate = 0.0
+        self.max_files = 1000
+        self.max_age = 3600
+        self._header = None
+        self._signer = None
+        self._url_map = None
+        self._logger = None
+
+    def init_app(self, app):
+        """Wrap the WSGI application of `app` if profiling is enabled.
+
+        Args:
+            app: Application instance
+        """
+        self.directory = app.config.get('PROFILER_DIR') or \
+            os.path.join(app.instance_path, 'profiles')
+        self.enabled = app.config.get('PROFILER_ENABLED', False)
+
+        if not self.enabled:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0.0)
+        self.max_files = app.config.get('PROFILER_MAX_FILES', 1000)
+        self.max_age = app.config.get('PROFILER_HEADER_MAX_AGE', 3600)
+        self._header = 'HTTP_' + app.config.get('PROFILER_HEADER', 'X-Profile') \
+            .upper().replace('-', '_')
+        self._signer = self._make_signer(app.secret_key)
+        self._url_map = app.url_map
+        self._logger = app.logger
+
+        app.wsgi_app = self._wrap(app.wsgi_app)
+
+    @staticmethod
+    def _make_signer(secret_key: str) -> TimestampSigner:
+        return TimestampSigner(secret_key, salt='request-profiler')
+
+    def make_token(self) -> str:
+        """Generate a value for the header requesting a profile.
+
+        Returns:
+            Signed value, valid for `PROFILER_HEADER_MAX_AGE` seconds.
+        """
+        return self._make_signer(current_app.secret_key).sign('profile').decode()
+
+    def _wrap(self, wsgi_app: Callable) -> Callable:
+        """Wrap a WSGI application to profile sampled requests."""
+        @functools.wraps(wsgi_app)
+        def profiled_app(environ, start_response):
+            requested = self._is_requested(environ)
+
+            if not requested and random.random() >= self.sample_rate:
+                return wsgi_app(environ, start_response)
+
+            return self._profile(wsgi_app, environ, start_response, requested)
+
+        return profiled_app
+
+    def _is_requested(self, environ: dict) -> bool:
+        """Check whether the request includes a valid signed header."""
+        value = environ.get(self._header)
+
+        if not value:
+            return False
+
+        try:
+            return self._signer.unsign(value, max_age=self.max_age) == b'profile'
+
+        except BadSignature:
+            return False
+
+    def _endpoint(self, environ: dict) -> str:
+        """Obtain the endpoint matching the request."""
+        try:
+            return self._url_map.bind_to_environ(environ).match()[0]
+
+        except HTTPException:
+            return 'none'
+
+    def _profile(self, wsgi_app: Callable, environ: dict, start_response: Callable,
+                 requested: bool):
+        """Run the request under the profiler and store the profile."""
+        profiles = sum(1 for entry in os.listdir(self.directory) if entry.endswith('.prof'))
+
+        if profiles >= self.max_files:
+            return wsgi_app(environ, start_response)
+
+        # Endpoints may contain any character, so they are stored separately
+        name = '{:%Y%m%d-%H%M%S}-{}.prof'.format(
+            datetime.datetime.utcnow(),
+            secrets.token_hex(4)
+        )
+        metadata = {
+            'method': environ.get('REQUEST_METHOD', 'GET'),
+            'endpoint': self._endpoint(environ),
+            'path': environ.get('PATH_INFO', '/'),
+        }
+
+        def profiled_start_response(status, headers, exc_info=None):
+            # Only disclosed to those allowed to request profiles
+            if requested:
+                headers.append(('X-Profile-File', name))
+
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+
+        except ValueError:
+            # Another profiler is active in this thread
+            return wsgi_app(environ, start_response)
+
+        start = time.perf_counter()
+
+        try:
+            app_iter = wsgi_app(environ, profiled_start_response)
+
+            try:
+                body = b''.join(app_iter)
+
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+
+        finally:
+            profile.disable()
+            metadata['duration'] = time.perf_counter() - start
+
+        path = os.path.join(self.directory, name)
+
+        try:
+            with open(path[:-len('.prof')] + '.json', 'w') as f:
+                json.dump(metadata, f)
+
+            # Written under a temporary name so that reports only read
+            # complete profiles
+            profile.dump_stats(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+        except OSError:
+            self._logger.exception('Failed to store profile %s' % name)
+
+        return [body]
@@ -3,14 +3,27 @@
 """Database model definitions."""
 
 import datetime
+import secrets
+import string
 import time
 from typing import Optional
 
 import sqlalchemy
+from flask import current_app
 from flask_login import UserMixin
-from passlib.pwd import genword
+from sqlalchemy.orm import make_transient_to_detached
 
-from . import db, user_hasher
+from . import db, user_cache, user_hasher
+
+
+# Same characters used by `passlib.pwd.genword()`, which is much slower to
+# import
+_ALPHABET = string.ascii_letters + string.digits
+
+
+def _random_word(length: int) -> str:
+    """Generate a random alphanumeric string."""
+    return ''.join(secrets.choice(_ALPHABET) for _ in range(length))
 
 
 class Invitation(db.Model):
@@ -24,6 +37,11 @@ class Invitation(db.Model):
         expiration (datetime): Date at which the invitation is no longer valid.
     """
     __tablename__ = 'invitations'
+    __table_args__ = (
+        # Foreign keys are not indexed automatically by every database
+        db.Index('ix_invitations_owner_id', 'owner_id'),
+        db.Index('ix_invitations_user_id', 'user_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     owner_id = db.Column(
@@ -49,13 +67,13 @@ class Invitation(db.Model):
     token = db.Column(
         db.String(64),
         nullable=False,
-        default=genword(length=64),
+        default=lambda: Invitation.generate_token(),
         unique=True
     )
     expiration = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.datetime.utcnow()+datetime.timedelta(weeks=1),
+        default=lambda: datetime.datetime.utcnow() + datetime.timedelta(weeks=1),
         # If the server supports it:
         # server_default=sqlalchemy.sql.expression.text('NOW() + INTERVAL \'1 week\'')
     )
@@ -90,7 +108,46 @@ class Invitation(db.Model):
         Returns:
             Random token.
         """
-        return genword(length=64)
+        return _random_word(64)
+
+
+class OutboxMessage(db.Model):
+    """Email pending to be sent.
+
+    Messages are stored in the same transaction as the changes that generate
+    them and are sent later by `util.drain_outbox()`.
+
+    Attributes:
+        id (int): ID of the message.
+        subject (str): Subject of the email.
+        recipients (list): Email addresses of the recipients.
+        body (str): Plain text body of the email.
+        html (str): HTML body of the email, if any.
+        headers (dict): Sender, CC, BCC, reply-to and extra headers of the
+            email, as given to Flask-Mail.
+        created_at (datetime): Date at which the message was queued.
+        attempts (int): Number of failed attempts to send the message.
+        next_attempt_at (datetime): Date at which the message should be sent.
+        last_error (str): Error of the last failed attempt.
+    """
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (
+        db.Index('ix_mail_outbox_next_attempt_at', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    recipients = db.Column(db.JSON, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=True)
+    headers = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False,
+                         default=0, server_default='0')
+    next_attempt_at = db.Column(db.DateTime, nullable=False,
+                                default=datetime.datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
 
 
 class User(db.Model, UserMixin):
@@ -133,11 +190,14 @@ class User(db.Model, UserMixin):
                        default=lambda: User.generate_serial())
 
     joined_at = db.Column(db.DateTime, nullable=False,
-                          default=datetime.datetime.utcnow(),
+                          default=datetime.datetime.utcnow,
                           server_default=sqlalchemy.sql.func.now())
     password_reset_token = db.Column(db.String(100), nullable=True, unique=True)
     password_reset_expiration = db.Column(db.DateTime, nullable=True)
 
+    # Attributes that are never stored in the user cache
+    _uncached = ('password', 'password_reset_token', 'password_reset_expiration')
+
     @property
     def hashid(self) -> str:
         """Calculate the Hashid from user ID."""
@@ -155,7 +215,16 @@ class User(db.Model, UserMixin):
         Returns:
             Serial string.
         """
-        return '{}{}'.format(int(time.time()), genword(length=length))
+        return '{}{}'.format(int(time.time()), _random_word(length))
+
+    @staticmethod
+    def generate_reset_token() -> str:
+        """Generate a random token for password resets.
+
+        Returns:
+            Random token.
+        """
+        return _random_word(64)
 
     @classmethod
     def get_by_username(cls, username: str) -> Optional['User']:
@@ -181,6 +250,81 @@ class User(db.Model, UserMixin):
         """
         return cls.query.filter_by(email=email).first()
 
+    @classmethod
+    def login_query(cls, identity: str) -> sqlalchemy.orm.Query:
+        """Build the query to find an active user by username or email.
+
+        Each branch of the union uses its own index, as opposed to an `OR` of
+        both columns, which some databases resolve with a full scan. Emails
+        must match exactly (see `email_query()`).
+
+        Args:
+            identity (str): Username or email.
+
+        Returns:
+            Query for the user.
+        """
+        by_username = (
+            cls.query
+            .filter(cls.username == identity)
+            .filter(cls.is_active == True)
+        )
+        return by_username.union(cls.email_query(identity))
+
+    @classmethod
+    def email_query(cls, email: str) -> sqlalchemy.orm.Query:
+        """Build the query to find an active user by email.
+
+        Emails are compared exactly, as their uniqueness is case-sensitive:
+        a case-insensitive match may find several users.
+
+        Args:
+            email (str): Email of the user.
+
+        Returns:
+            Query for the user.
+        """
+        return (
+            cls.query
+            .filter(cls.email == email)
+            .filter(cls.is_active == True)
+        )
+
+    @classmethod
+    def session_query(cls, uid: str, serial: str) -> sqlalchemy.orm.Query:
+        """Build the query to find an active user by session ID.
+
+        Args:
+            uid (str): User ID.
+            serial (str): Session serial.
+
+        Returns:
+            Query for the user.
+        """
+        return (
+            cls.query
+            .filter_by(id=uid)
+            .filter_by(serial=serial)
+            .filter_by(is_active=True)
+        )
+
+    @classmethod
+    def reset_token_query(cls, token: str) -> sqlalchemy.orm.Query:
+        """Build the query to find an active user by valid reset token.
+
+        Args:
+            token (str): Password reset token.
+
+        Returns:
+            Query for the user.
+        """
+        return (
+            cls.query
+            .filter_by(password_reset_token=token)
+            .filter_by(is_active=True)
+            .filter(cls.password_reset_expiration >= datetime.datetime.utcnow())
+        )
+
     def get_id(self) -> str:
         """Return the ID to use for the login manager.
 
@@ -192,3 +336,94 @@ class User(db.Model, UserMixin):
             ID to use for session tokens.
         """
         return '{}_{}'.format(self.id, self.serial)
+
+    def to_cache(self) -> dict:
+        """Obtain the attributes to store in the user cache.
+
+        Credentials are excluded and will be loaded from the database on
+        access instead.
+
+        Returns:
+            Dict with column names and values.
+        """
+        return {
+            c.name: getattr(self, c.name)
+            for c in self.__table__.columns
+            if c.name not in self._uncached
+        }
+
+    @classmethod
+    def from_cache(cls, data: dict) -> 'User':
+        """Restore a user from the attributes stored in the user cache.
+
+        The instance is merged into the current session without querying the
+        database, so it can be modified and committed as usual.
+
+        Args:
+            data (dict): Attributes obtained through `to_cache()`.
+
+        Returns:
+            User instance.
+        """
+        user = cls(**data)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
+
+def hot_queries() -> list:
+    """Obtain the most frequent queries with sample parameters.
+
+    Used to inspect their plans (`myapp db explain`) and to warm up the
+    compiled statement cache of new workers.
+
+    Returns:
+        List of (name, query) tuples.
+    """
+    return [
+        ('load_user', User.session_query('1', 'serial')),
+        ('login (username or email)', User.login_query('user@example.com')),
+        ('reset_password', User.reset_token_query('token')),
+        ('signup (invitation token)', Invitation.query.filter_by(token='token')),
+        ('forgot_password', User.email_query('user@example.com')),
+    ]
+
+
+@sqlalchemy.event.listens_for(User, 'after_update')
+@sqlalchemy.event.listens_for(User, 'after_delete')
+def _queue_user_invalidation(mapper, connection, target):
+    """Mark a modified user for removal from the user cache.
+
+    Removal is deferred until the transaction is committed so that no other
+    request can cache the old values in the meantime.
+    """
+    session = sqlalchemy.orm.object_session(target)
+
+    if session is not None:
+        session.info.setdefault('invalidated_users', set()).add(str(target.id))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _invalidate_users(session):
+    """Remove users modified in the transaction from the user cache.
+
+    Failures (e.g. the shared backend being down) are only logged, as the
+    changes are already committed. Entries not invalidated expire after
+    `USER_CACHE_TTL` seconds.
+    """
+    uids = session.info.pop('invalidated_users', None)
+
+    if not uids:
+        return
+
+    try:
+        user_cache.invalidate(*uids)
+
+    except Exception:
+        current_app.logger.exception('Failed to invalidate cached users %s' % ', '.join(uids))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _discard_user_invalidation(session):
+    """Forget pending invalidations of a rolled back transaction."""
+    session.info.pop('invalidated_users', None)
@@ -3,19 +3,34 @@
 """Application utilities."""
 
 import datetime
+import functools
+import os
+import re
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
 from urllib.parse import urlparse, urljoin
 
 import pytz
+import sqlalchemy
 
 from babel import dates as babel_dates
-from flask import current_app, request, url_for
+from flask import abort, current_app, g, has_request_context, \
+    render_template, request, url_for
+from flask_babel import force_locale, gettext
 from flask_login import current_user
 from flask_mail import Message
+from itsdangerous import BadSignature
+from markupsafe import Markup
 
-from . import babel, mail
+from . import babel, crypto_manager, db, mail_pool
 from .bootstrap import LANGUAGES
+from .helpers import KeysetPagination, StartupTimer
+
+
+# Background executor used to upgrade password hashes
+_rehash_executor = None
+_rehash_pid = None
 
 
 # Localization
@@ -29,10 +44,48 @@ def get_locale() -> Optional[str]:
 
 
 # Miscellaneous
+_COMMON_TIMEZONES = frozenset(pytz.common_timezones)
+
+# Message attributes stored in the `headers` of outbox messages
+_OUTBOX_HEADERS = ('sender', 'cc', 'bcc', 'reply_to', 'extra_headers')
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_timezone(name: Optional[str], default: str) -> datetime.tzinfo:
+    """Obtain the timezone for a name, or the default one if not valid."""
+    if not name or name not in _COMMON_TIMEZONES:
+        name = default
+
+    return babel_dates.get_timezone(name)
+
+
+def get_user_timezone() -> datetime.tzinfo:
+    """Obtain the timezone used to represent dates in the current context.
+
+    This is `g.forced_timezone` (e.g. when rendering emails) or the timezone
+    of the current user. If a valid timezone is not set, will use application
+    default. Resolved timezones are cached.
+    """
+    name = g.get('forced_timezone') or getattr(current_user, 'timezone', None)
+
+    return _resolve_timezone(
+        name,
+        current_app.config.get('BABEL_DEFAULT_TIMEZONE', 'UTC')
+    )
+
+
+def _format_in_timezone(value: datetime.datetime, tz: datetime.tzinfo) -> str:
+    """Represent a datetime in a timezone, naive values being in UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+
+    return value.astimezone(tz).strftime('%Y-%m-%d %H:%M:%S')
+
+
 def format_datetime(value: datetime.datetime) -> str:
     """Jinja filter to format datetime using user defined timezone.
 
-    If a valid timezone is not set, will use application default.
+    See `get_user_timezone()` for the timezone used.
 
     Args:
         value (datetime): Datetime object to represent.
@@ -40,18 +93,24 @@ def format_datetime(value: datetime.datetime) -> str:
     Returns:
         String representation of the datetime object.
     """
-    user_tz = current_user.timezone
+    return _format_in_timezone(value, get_user_timezone())
 
-    if not user_tz or user_tz not in pytz.common_timezones:
-        user_tz = current_app.config.get('BABEL_DEFAULT_TIMEZONE', 'UTC')
 
-    tz = babel_dates.get_timezone(user_tz)
+def format_datetimes(values: Iterable[datetime.datetime]) -> List[str]:
+    """Jinja filter to format several datetimes using user defined timezone.
 
-    return babel_dates.format_datetime(
-        value,
-        'yyyy-MM-dd HH:mm:ss',
-        tzinfo=tz
-    )
+    The timezone is resolved once for all the values, which is preferred
+    when formatting many dates (e.g. in lists).
+
+    Args:
+        values: Datetime objects to represent.
+
+    Returns:
+        String representations of the datetime objects, in the same order.
+    """
+    tz = get_user_timezone()
+
+    return [_format_in_timezone(value, tz) for value in values]
 
 
 def is_ajax() -> bool:
@@ -66,6 +125,38 @@ def is_ajax() -> bool:
     return request.headers.get('X-WITH-AJAX', 'false') == 'true'
 
 
+def paginate_keyset(query, *key, per_page: Optional[int] = None) -> KeysetPagination:
+    """Paginate a query by its ordering key using the current request.
+
+    The page is located through the `after` or `before` query arguments, as
+    generated by the `render_keyset_pagination()` template macro. See
+    `KeysetPagination` for details.
+
+    Args:
+        query: SQLAlchemy ORM query to paginate, without ordering.
+        key: Columns of the ordering key, which must be unique.
+        per_page (int): Number of items per page. Defaults to the
+            `ITEMS_PER_PAGE` configuration variable.
+
+    Returns:
+        `KeysetPagination` instance.
+
+    Raises:
+        `BadRequest` if the cursor is not valid.
+    """
+    try:
+        return KeysetPagination(
+            query,
+            list(key),
+            per_page or current_app.config['ITEMS_PER_PAGE'],
+            after=request.args.get('after'),
+            before=request.args.get('before')
+        )
+
+    except BadSignature:
+        abort(400)
+
+
 def is_safe_url(target: str) -> bool:
     """Check whether the target is safe for redirection.
 
@@ -82,16 +173,303 @@ def is_safe_url(target: str) -> bool:
            ref_url.netloc == test_url.netloc
 
 
-def send_email(*args, **kwargs):
+def rehash_password(user, password: str):
+    """Upgrade the password hash of a user in the background.
+
+    This should be called after verifying the password of the user, whenever
+    `crypto_manager.needs_update()` reports that the stored hash uses a
+    deprecated scheme or cost. The new hash is computed and stored outside of
+    the request, and is only saved if the stored hash did not change in the
+    meantime. Session serials are kept, so existing sessions remain valid.
+
+    Args:
+        user: User instance.
+        password (str): Plain password already verified for the user.
+    """
+    global _rehash_executor, _rehash_pid
+
+    if _rehash_pid != os.getpid():
+        _rehash_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='rehash'
+        )
+        _rehash_pid = os.getpid()
+
+    _rehash_executor.submit(
+        _store_rehashed_password,
+        current_app._get_current_object(),
+        user.id,
+        user.password,
+        password
+    )
+
+
+def _store_rehashed_password(app, user_id: int, old_hash: str, password: str):
+    """Hash a password and replace the previous hash of the user."""
+    from .models import User
+
+    with app.app_context():
+        try:
+            updated = (
+                User.query
+                .filter_by(id=user_id)
+                .filter_by(password=old_hash)
+                .update(
+                    {'password': crypto_manager.hash(password)},
+                    synchronize_session=False
+                )
+            )
+            db.session.commit()
+
+            if updated:
+                app.logger.info('Upgraded password hash of user %s' % user_id)
+
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Failed to upgrade password hash of user %s' % user_id)
+
+
+def queue_email(*args, template: Optional[str] = None,
+                context: Optional[dict] = None, locale: Optional[str] = None,
+                timezone: Optional[str] = None, **kwargs):
+    """Send an email once the current database transaction is committed.
+
+    If the `MAIL_OUTBOX` setting is enabled, the message is rendered and added
+    to the outbox in the current session, to be sent by `drain_outbox()`.
+    With Celery, the task is sent right after the commit (so that the worker
+    finds the rows in its context) and discarded on rollback. Otherwise, the
+    message is sent right away, so that failures reach the caller and the
+    transaction can be rolled back.
+
+    Arguments are the same as in `send_email()`.
+
+    Raises:
+        `ValueError` if the outbox is enabled and the message has attachments,
+        a date, a charset or SMTP options, which cannot be stored.
+    """
+    if current_app.config.get('MAIL_OUTBOX', False):
+        from .models import OutboxMessage
+
+        args, kwargs = _translate_subject(args, kwargs, locale)
+
+        if template is not None:
+            kwargs['body'] = render_email(template, locale, timezone, **(context or {}))
+
+        message = Message(*args, **kwargs)
+
+        if message.attachments or message.date or message.charset or \
+                message.mail_options or message.rcpt_options:
+            raise ValueError(
+                'Attachments, dates, charsets and SMTP options are not '
+                'supported by the outbox'
+            )
+
+        db.session.add(OutboxMessage(
+            subject=message.subject,
+            recipients=message.recipients,
+            body=message.body,
+            html=message.html,
+            headers={
+                key: getattr(message, key) for key in _OUTBOX_HEADERS
+                if getattr(message, key)
+            }
+        ))
+
+        return
+
+    # Prepare now, as no queries can be performed after the commit
+    email = _prepare_email(args, kwargs, template, context, locale, timezone)
+
+    if not current_app.config.get('USE_CELERY', False):
+        _dispatch_email(*email)
+        return
+
+    db.session.info.setdefault('queued_emails', []).append(email)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _send_queued_emails(session):
+    """Send the tasks of the emails queued during a committed transaction."""
+    for args, kwargs in session.info.pop('queued_emails', []):
+        try:
+            _dispatch_email(args, kwargs)
+
+        except Exception:
+            current_app.logger.exception('Failed to send email')
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _discard_queued_emails(session):
+    """Discard the emails queued during a rolled back transaction."""
+    session.info.pop('queued_emails', None)
+
+
+def drain_outbox(batch_size: int = 100) -> tuple:
+    """Send a batch of messages from the outbox.
+
+    Messages are sent through the pool of persistent SMTP connections. Failed
+    messages are retried with exponential backoff (`MAIL_OUTBOX_BACKOFF`
+    seconds, doubled on every attempt) until `MAIL_OUTBOX_MAX_ATTEMPTS` is
+    reached, after which they are kept in the outbox with their last error.
+
+    When supported by the database, the batch is locked so that several
+    workers can drain the outbox concurrently. Delivery is at-least-once:
+    if the process dies before committing, the batch will be sent again.
+
+    Args:
+        batch_size (int): Maximum number of messages to send.
+
+    Returns:
+        Tuple with the number of sent and failed messages.
+    """
+    from .models import OutboxMessage
+
+    max_attempts = current_app.config.get('MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+    backoff = current_app.config.get('MAIL_OUTBOX_BACKOFF', 60)
+    now = datetime.datetime.utcnow()
+
+    messages = (
+        OutboxMessage.query
+        .filter(OutboxMessage.next_attempt_at <= now)
+        .filter(OutboxMessage.attempts < max_attempts)
+        .order_by(OutboxMessage.next_attempt_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    sent, failed = 0, 0
+
+    for message in messages:
+        try:
+            mail_pool.send(Message(
+                message.subject,
+                recipients=message.recipients,
+                body=message.body,
+                html=message.html,
+                **(message.headers or {})
+            ))
+
+        except Exception as e:
+            failed += 1
+            current_app.logger.warning('Failed to send message %s: %s' % (message.id, e))
+
+            message.attempts += 1
+            message.last_error = str(e)
+            message.next_attempt_at = now + datetime.timedelta(
+                seconds=backoff * 2 ** (message.attempts - 1)
+            )
+
+        else:
+            sent += 1
+            db.session.delete(message)
+
+    db.session.commit()
+
+    return sent, failed
+
+
+def render_email(template: str, locale: Optional[str] = None,
+                 timezone: Optional[str] = None, **context) -> str:
+    """Render an email template in the given locale and timezone.
+
+    Args:
+        template (str): Name of the template.
+        locale (str): Locale code, defaults to the current one.
+        timezone (str): Timezone for dates, defaults to the current one.
+        context: Template context.
+
+    Returns:
+        Rendered template.
+    """
+    with force_locale(locale or get_locale() or current_app.config.get('BABEL_DEFAULT_LOCALE', 'en')):
+        previous = g.get('forced_timezone')
+        g.forced_timezone = timezone
+
+        try:
+            return render_template(template, **context)
+
+        finally:
+            g.forced_timezone = previous
+
+
+def send_email(*args, template: Optional[str] = None,
+               context: Optional[dict] = None, locale: Optional[str] = None,
+               timezone: Optional[str] = None, **kwargs):
     """Send an email.
 
-    Emails are sent asynchronously if Celery is enabled.
+    Emails are sent asynchronously if Celery is enabled. Otherwise, they are
+    sent through the pool of persistent SMTP connections.
 
-    All arguments are passed as-is to Flask-Mail.
+    Instead of a `body`, a `template` and its `context` may be given. When
+    using Celery, the template is rendered by the worker: model instances in
+    the context are sent as references and loaded again by the worker, so
+    they must exist in the database. Templates are rendered in the given
+    `locale` and `timezone`, which default to those of the current request.
+    The subject should be a lazy string (`lazy_gettext()`), translated in the
+    same locale.
+
+    Remaining arguments are passed as-is to Flask-Mail.
 
     Returns:
         Mail send result or `None`.
     """
+    email = _prepare_email(args, kwargs, template, context, locale, timezone)
+
+    return _dispatch_email(*email)
+
+
+def _prepare_email(args: tuple, kwargs: dict, template: Optional[str],
+                   context: Optional[dict], locale: Optional[str],
+                   timezone: Optional[str]) -> tuple:
+    """Obtain the arguments for `_dispatch_email()`.
+
+    Templates are rendered here unless Celery is enabled, in which case the
+    arguments needed to render them in the worker are added instead.
+    """
+    if not locale:
+        locale = get_locale() or current_app.config.get('BABEL_DEFAULT_LOCALE', 'en')
+
+    args, kwargs = _translate_subject(args, kwargs, locale)
+
+    if template is None:
+        return args, kwargs
+
+    if not timezone and current_user and current_user.is_authenticated:
+        timezone = current_user.timezone
+
+    if not current_app.config.get('USE_CELERY', False):
+        kwargs['body'] = render_email(template, locale, timezone, **(context or {}))
+        return args, kwargs
+
+    kwargs.update(
+        template=template,
+        context=dump_context(context or {}),
+        locale=str(locale),
+        timezone=timezone,
+        base_url=request.host_url if has_request_context() else None
+    )
+
+    return args, kwargs
+
+
+def _translate_subject(args: tuple, kwargs: dict, locale: Optional[str]) -> tuple:
+    """Translate the subject of an email in the locale of the recipients.
+
+    Lazy strings are evaluated here, as they cannot be stored or sent to
+    Celery workers.
+    """
+    with force_locale(locale or get_locale() or current_app.config.get('BABEL_DEFAULT_LOCALE', 'en')):
+        if args:
+            args = (str(args[0]),) + tuple(args[1:])
+
+        elif kwargs.get('subject') is not None:
+            kwargs['subject'] = str(kwargs['subject'])
+
+    return args, kwargs
+
+
+def _dispatch_email(args: tuple, kwargs: dict):
+    """Send a prepared email, through Celery if enabled."""
     if current_app.config.get('USE_CELERY', False):
         from .async_tasks import async_mail
 
@@ -100,7 +478,190 @@ def send_email(*args, **kwargs):
     else:
         message = Message(*args, **kwargs)
 
-        return mail.send(message)
+        return mail_pool.send(message)
+
+
+def dump_context(context: dict) -> dict:
+    """Convert a template context to a serializable one.
+
+    Model instances are replaced with references to their primary key. Any
+    other value must already be serializable.
+    """
+    dumped = {}
+
+    for key, value in context.items():
+        if isinstance(value, db.Model):
+            if value.id is None:
+                db.session.flush()
+
+            value = {'__model__': value.__class__.__name__, 'id': value.id}
+
+        dumped[key] = value
+
+    return dumped
+
+
+def load_context(context: dict) -> dict:
+    """Restore a template context obtained through `dump_context()`."""
+    from . import models
+
+    loaded = {}
+
+    for key, value in context.items():
+        if isinstance(value, dict) and '__model__' in value:
+            value = getattr(models, value['__model__']).query.get(value['id'])
+
+        loaded[key] = value
+
+    return loaded
+
+
+# Fingerprinted files generated by `myapp assets build`
+_FINGERPRINTED_ASSET = re.compile(r'^dist/.+\.[0-9a-f]{8,}\.[a-z]+$')
+
+
+def warm_up(connections: Optional[int] = None) -> dict:
+    """Initialize the components that would otherwise be loaded by the first
+    requests of a worker.
+
+    This configures the SQLAlchemy mappers, loads the password hash backends,
+    translations for every language, templates and timezones, and opens
+    database connections. Database steps are skipped when no connection is
+    requested, which must be the case before forking (e.g. when called from
+    `init_app()`), as connections cannot be shared between processes.
+
+    Must be called within an application context.
+
+    Args:
+        connections (int): Number of database connections to open. Defaults
+            to the `WARM_UP_CONNECTIONS` configuration variable.
+
+    Returns:
+        Dict with the time taken by each step, in seconds.
+    """
+    from .models import User, hot_queries
+
+    app = current_app._get_current_object()
+    timer = StartupTimer()
+
+    if connections is None:
+        connections = app.config.get('WARM_UP_CONNECTIONS', 1)
+
+    sqlalchemy.orm.configure_mappers()
+    timer.mark('mappers')
+
+    crypto_manager.warm_up()
+    timer.mark('crypto')
+
+    # Flask-Babel caches the catalog of each locale once loaded
+    with app.test_request_context():
+        for language in LANGUAGES:
+            with force_locale(language):
+                gettext('Home')
+
+    timer.mark('translations')
+
+    for name in app.jinja_env.list_templates(extensions=('html', 'txt')):
+        app.jinja_env.get_template(name)
+
+    timer.mark('templates')
+
+    default_timezone = app.config.get('BABEL_DEFAULT_TIMEZONE', 'UTC')
+    timezones = {default_timezone}
+
+    if connections:
+        # Open the connections at the same time so that they stay in the pool
+        pending = [db.engine.connect() for _ in range(connections)]
+
+        for connection in pending:
+            connection.close()
+
+        timer.mark('connections')
+
+        # Populate the compiled statement cache
+        for _, query in hot_queries():
+            query.all()
+
+        timezones.update(tz for (tz,) in db.session.query(User.timezone).distinct())
+        db.session.remove()
+
+        timer.mark('queries')
+
+    for name in timezones:
+        _resolve_timezone(name, default_timezone)
+
+    timer.mark('timezones')
+
+    app.logger.info(
+        'Warm-up completed in %.1f ms (%s)',
+        sum(timer.timings.values()) * 1000,
+        ', '.join(
+            '{} {:.1f} ms'.format(step, elapsed * 1000)
+            for step, elapsed in timer.timings.items()
+        )
+    )
+
+    return timer.timings
+
+
+def set_asset_cache_headers(response):
+    """Allow clients and proxies to cache fingerprinted assets forever.
+
+    As the name of these files changes whenever their contents change, they
+    are served with a far-future expiration (`ASSETS_CACHE_MAX_AGE`) and
+    marked as immutable so that they are never revalidated.
+
+    Args:
+        response: Response of the request.
+
+    Returns:
+        Response with updated headers.
+    """
+    if request.endpoint != 'static' or response.status_code != 200:
+        return response
+
+    filename = (request.view_args or {}).get('filename', '')
+
+    if _FINGERPRINTED_ASSET.match(filename):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('ASSETS_CACHE_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+
+    return response
+
+
+def svg_icon(name: str, classes: str = '') -> Markup:
+    """Render an icon from the SVG sprite.
+
+    The sprite is generated from the icons referenced in templates, therefore
+    names must be given as string literals (e.g. `svg_icon('home')`), through
+    the `icon` arguments of the form macros or listed in `ASSETS_EXTRA_ICONS`
+    in order to be included.
+
+    Args:
+        name (str): Name of the Font Awesome (solid) icon.
+        classes (str): Additional classes for the element.
+
+    Returns:
+        Markup for the icon.
+
+    Raises:
+        `ValueError` if the icon is not in the sprite, only checked when
+        assets are built automatically (i.e. outside production).
+    """
+    bundle = current_app.jinja_env.assets_environment['icons']
+
+    # Checking parses the templates, which is avoided with prebuilt assets
+    if current_app.config['ASSETS_AUTO_BUILD'] and name not in bundle.icons:
+        raise ValueError('Icon {} is not in the sprite, add it to ASSETS_EXTRA_ICONS'.format(name))
+
+    if 'icon_sprite_url' not in g:
+        g.icon_sprite_url = bundle.urls()[0]
+
+    return Markup(
+        '<svg class="{}" aria-hidden="true"><use href="{}#{}"></use></svg>'
+    ).format(' '.join(('fa', classes)).strip(), g.icon_sprite_url, name)
 
 
 def url_for_self(**kwargs) -> str:
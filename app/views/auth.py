@@ -6,16 +6,16 @@ import datetime
 
 from flask import Blueprint, current_app, flash, redirect, render_template, \
     request, url_for
-from flask_babel import _
+from flask_babel import _, lazy_gettext as _l
 from flask_login import confirm_login, current_user, login_user, logout_user, \
     login_required
-from sqlalchemy import or_, exc as dbexc
+from sqlalchemy import exc as dbexc
 
-from .. import db, crypto_manager
+from .. import db, crypto_manager, login_throttle
 from ..forms import InviteForm, LoginForm, ForgotPasswordForm, \
     ReauthenticationForm, PasswordResetForm, SignupForm
 from ..models import Invitation, User
-from ..util import is_safe_url, send_email
+from ..util import is_safe_url, queue_email, rehash_password
 
 
 bp_auth = Blueprint('auth', __name__)
@@ -27,17 +27,14 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        # Reject excessive attempts before doing any expensive work
+        if not login_throttle.allow(request.remote_addr, form.identity.data):
+            flash(_('Too many login attempts, please try again later'), 'error')
+
+            return render_template('auth/login.html', form=form), 429
+
         # Check credentials
-        user = (
-            User.query
-            .filter(
-                or_(
-                    User.username==form.identity.data,
-                    User.email==form.identity.data
-                )
-            )
-            .filter(User.is_active==True)
-        ).first()
+        user = User.login_query(form.identity.data).first()
 
         if not user or not crypto_manager.verify(form.password.data, user.password):
             # Show invalid credentials message
@@ -45,6 +42,10 @@ def login():
 
             return render_template('auth/login.html', form=form)
 
+        # Upgrade deprecated hashes outside of the request
+        if crypto_manager.needs_update(user.password):
+            rehash_password(user, form.password.data)
+
         # Log the user in
         if login_user(user, remember=form.remember_me.data):
             flash(_('Logged in successfully'), 'success')
@@ -122,11 +123,7 @@ def forgot_password():
 
     if form.validate_on_submit():
         # Verify user (must be active)
-        user = (
-            User.query
-            .filter_by(email=form.email.data)
-            .filter_by(is_active=True)
-        ).first()
+        user = User.email_query(form.email.data).first()
 
         if not user:
             # Don't let the user know
@@ -141,18 +138,19 @@ def forgot_password():
 
         try:
             correct = True
-            db.session.commit()
 
             # Send notification email
-            send_email(
-                _('Password reset'),
+            queue_email(
+                _l('Password reset'),
                 recipients=[user.email],
-                body=render_template(
-                    'emails/auth/forgot_password.txt',
-                    user=user
-                )
+                template='emails/auth/forgot_password.txt',
+                context={'user': user},
+                locale=user.locale,
+                timezone=user.timezone
             )
 
+            db.session.commit()
+
             flash(_('A password reset token has been sent'), 'success')
             return render_template('auth/forgot_password.html', form=form)
 
@@ -185,13 +183,7 @@ def reset_password(token):
         logout_user()
 
     # Verify token
-    now = datetime.datetime.utcnow()
-    user = (
-        User.query
-        .filter_by(password_reset_token=token)
-        .filter_by(is_active=True)
-        .filter(User.password_reset_expiration >= now)
-    ).first()
+    user = User.reset_token_query(token).first()
 
     if not user:
         flash(_('Invalid password reset token provided'), 'error')
@@ -204,20 +196,23 @@ def reset_password(token):
         # Update user
         user.password = crypto_manager.hash(form.password.data)
         user.password_reset_token = None
-        user.password_password_reset_expiration = None
+        user.password_reset_expiration = None
         user.serial = user.generate_serial()
 
         try:
             correct = True
-            db.session.commit()
 
             # Send notification email
-            send_email(
-                _('Password reset notification'),
+            queue_email(
+                _l('Password reset notification'),
                 recipients=[user.email],
-                body=render_template('email/auth/reset_password.txt')
+                template='emails/auth/reset_password.txt',
+                locale=user.locale,
+                timezone=user.timezone
             )
 
+            db.session.commit()
+
             flash(_('Password updated, you may now login'), 'success')
             return redirect(url_for('auth.login'))
 
@@ -265,19 +260,16 @@ def invite():
         try:
             correct = True
             db.session.add(new_invitation)
+            db.session.flush()
 
-            body = render_template(
-                'emails/auth/invite.txt',
-                user=current_user,
-                invitation=new_invitation
-            )
-
-            current_app.logger.debug('Generated email:\n%s' % body)
-
-            send_email(
-                _('%(site)s invitation', site=current_app.config['SITENAME']),
+            queue_email(
+                _l('%(site)s invitation', site=current_app.config['SITENAME']),
                 recipients=[form.email.data],
-                body=body
+                template='emails/auth/invite.txt',
+                context={
+                    'user': current_user._get_current_object(),
+                    'invitation': new_invitation
+                }
             )
 
             current_app.logger.info(
@@ -0,0 +1,366 @@
+"""Load test of the authentication flows.
+
+Seeds a new SQLite database with synthetic users and invitations, then sends
+concurrent requests to each endpoint through the Flask test client (one
+thread per simulated client, so the results include contention for the GIL
+and the database) and reports throughput and latency percentiles.
+
+The configuration in `APP_CONFIG` is used if set, with the database, mail,
+CSRF protection and login throttling overridden for the benchmark. Passwords
+are hashed with few bcrypt rounds by default so that the application code
+dominates the results. Store the results as JSON to compare them between
+commits:
+
+    $ python benchmarks/auth_flows.py --output before.json
+    $ git checkout <branch>
+    $ python benchmarks/auth_flows.py --compare before.json
+"""
+
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+
+# Password of every seeded user
+PASSWORD = 'benchmark-password'
+
+# Configuration applied on top of `APP_CONFIG`
+CONFIG_OVERRIDES = '''
+SQLALCHEMY_DATABASE_URI = {database!r}
+SQLALCHEMY_ENGINE_OPTIONS = {{'connect_args': {{'timeout': 30}}}}
+PASSLIB_ALG_BCRYPT_ROUNDS = {rounds!r}
+SECRET_KEY = 'benchmark'
+WTF_CSRF_ENABLED = False
+LOGIN_THROTTLE_ENABLED = False
+QUERY_MONITOR_ENABLED = False
+MAIL_SUPPRESS_SEND = True
+MAIL_DEFAULT_SENDER = 'benchmark@example.com'
+USE_CELERY = False
+'''
+
+# Status code expected from each endpoint
+EXPECTED_STATUS = {
+    'login': 302,
+    'signup': 302,
+    'invite': 302,
+    'forgot-password': 200,
+    'home': 200,
+}
+
+
+def _write_config(directory: str, database: str, rounds: int) -> str:
+    """Write the configuration file of the benchmark.
+
+    Returns:
+        Path of the file.
+    """
+    source = ''
+
+    if 'APP_CONFIG' in os.environ:
+        with open(os.environ['APP_CONFIG']) as f:
+            source = f.read()
+
+    path = os.path.join(directory, 'benchmark.cfg')
+
+    with open(path, 'w') as f:
+        f.write(source)
+        f.write(CONFIG_OVERRIDES.format(database='sqlite:///' + database, rounds=rounds))
+
+    return path
+
+
+def _seed(users: int, invitations: int, batch_size: int = 1000) -> list:
+    """Create the tables and insert the synthetic data.
+
+    Returns:
+        Tokens of the invitations.
+    """
+    from app import crypto_manager, db
+    from app.models import Invitation, User
+
+    db.create_all()
+
+    # Hashing once for every user keeps seeding fast
+    password = crypto_manager.hash(PASSWORD)
+    joined_at = datetime.datetime.utcnow()
+
+    for start in range(0, users, batch_size):
+        db.session.execute(User.__table__.insert(), [
+            {
+                'username': 'user{}'.format(i),
+                'email': 'user{}@example.com'.format(i),
+                'password': password,
+                'is_active': True,
+                'locale': 'en',
+                'timezone': 'UTC',
+                'invitations': invitations + users,
+                'serial': User.generate_serial(),
+                'joined_at': joined_at,
+            }
+            for i in range(start, min(users, start + batch_size))
+        ])
+
+    tokens = [Invitation.generate_token() for _ in range(invitations)]
+    expiration = joined_at + datetime.timedelta(days=7)
+    owner_ids = [row[0] for row in db.session.query(User.id)]
+
+    for start in range(0, invitations, batch_size):
+        db.session.execute(Invitation.__table__.insert(), [
+            {
+                'owner_id': owner_ids[i % len(owner_ids)],
+                'token': tokens[i],
+                'expiration': expiration,
+            }
+            for i in range(start, min(invitations, start + batch_size))
+        ])
+
+    db.session.commit()
+
+    return tokens
+
+
+class Flows(object):
+    """Requests of each endpoint, safe to call from several threads."""
+
+    def __init__(self, app, users: int, tokens: list, concurrency: int):
+        self.app = app
+        self.users = users
+        self.tokens = tokens
+        self._barrier = threading.Barrier(concurrency)
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _next(self) -> int:
+        """Obtain a number unique among every request."""
+        with self._lock:
+            self._counter += 1
+
+            return self._counter
+
+    def _login(self, client, user: int):
+        return client.post('/login', data={
+            'identity': 'user{}'.format(user),
+            'password': PASSWORD,
+        })
+
+    def _session(self):
+        """Client of the thread with a logged in user."""
+        client = getattr(self._local, 'client', None)
+
+        if client is None:
+            client = self._local.client = self.app.test_client()
+            self._login(client, self._next() % self.users)
+
+        return client
+
+    def prepare(self):
+        """Log in the user of the thread outside of the measurements.
+
+        Waits for the rest of the threads, so that each of them is prepared.
+        """
+        self._session()
+        self._barrier.wait()
+
+    def login(self):
+        return self._login(self.app.test_client(), self._next() % self.users)
+
+    def signup(self):
+        n = self._next()
+
+        return self.app.test_client().post(
+            '/signup/{}'.format(self.tokens.pop()),
+            data={
+                'username': 'new{}'.format(n),
+                'email': 'new{}@example.com'.format(n),
+                'plain_password': PASSWORD,
+                'confirm_password': PASSWORD,
+                'locale': 'en',
+                'timezone': 'UTC',
+            }
+        )
+
+    def invite(self):
+        return self._session().post('/invite', data={
+            'email': 'invited{}@example.com'.format(self._next()),
+        })
+
+    def forgot_password(self):
+        return self.app.test_client().post('/forgot-password', data={
+            'email': 'user{}@example.com'.format(self._next() % self.users),
+        })
+
+    def home(self):
+        return self._session().get('/')
+
+
+def _run(executor: ThreadPoolExecutor, send, expected: int, requests: int) -> dict:
+    """Send concurrent requests and measure them.
+
+    Returns:
+        Throughput, latency percentiles (in seconds) and number of errors.
+    """
+    def timed_request(_):
+        start = time.perf_counter()
+        status = send().status_code
+
+        return time.perf_counter() - start, status == expected
+
+    start = time.perf_counter()
+    results = list(executor.map(timed_request, range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, ok in results if not ok),
+        'throughput': requests / elapsed,
+        'mean': statistics.mean(latencies),
+        'p50': cuts[49],
+        'p95': cuts[94],
+        'p99': cuts[98],
+    }
+
+
+def _commit() -> str:
+    """Obtain the current commit, if running from a repository."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _change(current: float, previous: float) -> str:
+    """Format the relative change between two values."""
+    if not previous:
+        return ''
+
+    return '{:+.1f}%'.format((current - previous) / previous * 100)
+
+
+@click.command()
+@click.option('--users', default=1000, show_default=True,
+              help='number of seeded users')
+@click.option('--invitations', default=1000, show_default=True,
+              help='number of seeded invitations (each signup uses one)')
+@click.option('--requests', default=200, show_default=True,
+              type=click.IntRange(min=2),
+              help='requests sent to each endpoint')
+@click.option('--concurrency', default=4, show_default=True,
+              help='number of concurrent clients')
+@click.option('--warmup', default=10, show_default=True,
+              help='requests sent to each endpoint before measuring')
+@click.option('--rounds', default=4, show_default=True,
+              help='bcrypt rounds used to hash passwords')
+@click.option('--endpoint', 'endpoints', multiple=True,
+              type=click.Choice(list(EXPECTED_STATUS)),
+              help='endpoint to benchmark (all by default, may be repeated)')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True),
+              help='file to store the results as JSON')
+@click.option('--compare', type=click.File('r'),
+              help='results of a previous run to compare with')
+def main(users: int, invitations: int, requests: int, concurrency: int,
+         warmup: int, rounds: int, endpoints: tuple, output: str, compare):
+    """Benchmark the authentication endpoints."""
+    endpoints = endpoints or tuple(EXPECTED_STATUS)
+
+    if 'signup' in endpoints and invitations < requests + warmup:
+        raise click.BadParameter(
+            'at least {} are needed for signups'.format(requests + warmup),
+            param_hint='--invitations'
+        )
+
+    previous = json.load(compare)['endpoints'] if compare else {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['APP_CONFIG'] = _write_config(
+            directory,
+            os.path.join(directory, 'benchmark.sqlite'),
+            rounds
+        )
+
+        from app import init_app
+
+        app = init_app()
+
+        # Requests log their actions (e.g. invitations sent)
+        app.logger.setLevel(logging.WARNING)
+
+        with app.app_context():
+            start = time.perf_counter()
+            tokens = _seed(users, invitations)
+
+            click.echo('Seeded {} users and {} invitations in {:.1f} s\n'.format(
+                users,
+                invitations,
+                time.perf_counter() - start
+            ))
+
+        flows = Flows(app, users, tokens, concurrency)
+        executor = ThreadPoolExecutor(concurrency)
+
+        # Every thread of the pool logs in its user before measuring
+        list(executor.map(lambda _: flows.prepare(), range(concurrency)))
+
+        results = {}
+
+        click.echo('{:<16} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+            'Endpoint', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'Change'
+        ))
+
+        for name in endpoints:
+            send = getattr(flows, name.replace('-', '_'))
+            list(executor.map(lambda _: send(), range(warmup)))
+
+            results[name] = result = _run(executor, send, EXPECTED_STATUS[name], requests)
+
+            click.echo('{:<16} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>8}'.format(
+                name,
+                result['errors'],
+                result['throughput'],
+                result['p50'] * 1000,
+                result['p95'] * 1000,
+                result['p99'] * 1000,
+                _change(result['p50'], previous.get(name, {}).get('p50'))
+            ))
+
+        executor.shutdown()
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'commit': _commit(),
+                'date': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'options': {
+                    'users': users,
+                    'invitations': invitations,
+                    'requests': requests,
+                    'concurrency': concurrency,
+                    'rounds': rounds,
+                },
+                'endpoints': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Microbenchmark of the datetime Jinja filters.
+
+Compares formatting a list of datetimes with the previous implementation of
+`util.format_datetime` (timezone validated against a list and resolved on
+every call), the current filter and the batch `datetimes` filter.
+
+Set the `APP_CONFIG` environment variable before running:
+
+    $ python benchmarks/datetime_format.py --count 500
+"""
+
+import datetime
+import timeit
+
+import click
+import pytz
+
+from babel import dates as babel_dates
+from flask import current_app
+from flask_login import current_user
+
+
+def _previous_format_datetime(value: datetime.datetime) -> str:
+    """Previous implementation of `util.format_datetime`."""
+    user_tz = current_user.timezone
+
+    if not user_tz or user_tz not in pytz.common_timezones:
+        user_tz = current_app.config.get('BABEL_DEFAULT_TIMEZONE', 'UTC')
+
+    tz = babel_dates.get_timezone(user_tz)
+
+    return babel_dates.format_datetime(
+        value,
+        'yyyy-MM-dd HH:mm:ss',
+        tzinfo=tz
+    )
+
+
+@click.command()
+@click.option('--count', default=500, show_default=True,
+              help='datetimes formatted per run')
+@click.option('--runs', default=20, show_default=True, help='number of runs')
+@click.option('--timezone', default='Europe/Madrid', show_default=True,
+              help='timezone of the user')
+def main(count: int, runs: int, timezone: str):
+    """Benchmark datetime formatting."""
+    from flask_login import login_user
+
+    from app import init_app
+    from app.models import User
+    from app.util import format_datetime, format_datetimes
+
+    app = init_app()
+    start = datetime.datetime(2021, 1, 1)
+    values = [start + datetime.timedelta(hours=7 * i) for i in range(count)]
+
+    with app.test_request_context():
+        # Transient user, nothing is stored in the database
+        login_user(User(id=0, serial='', is_active=True, timezone=timezone))
+
+        previous = [_previous_format_datetime(v) for v in values]
+
+        if previous != format_datetimes(values) or \
+                previous != [format_datetime(v) for v in values]:
+            raise click.ClickException('Outputs differ from previous implementation')
+
+        cases = [
+            ('previous', lambda: [_previous_format_datetime(v) for v in values]),
+            ('datetime', lambda: [format_datetime(v) for v in values]),
+            ('datetimes', lambda: format_datetimes(values)),
+        ]
+
+        baseline = None
+
+        for name, case in cases:
+            best = min(timeit.repeat(case, number=1, repeat=runs))
+            baseline = baseline or best
+
+            click.echo('{:<10} {:>10.2f} ms {:>8.1f}x'.format(
+                name,
+                best * 1000,
+                baseline / best
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,3 +13,16 @@ app = init_app()
 from myapp.async_tasks import async_mail
 
 app.app_context().push()
+
+# Warm up every worker process
+from celery.signals import worker_process_init
+
+# Change 'myapp' to package name
+from myapp.util import warm_up
+
+
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    """Warm up the worker, including its database connections."""
+    with app.app_context():
+        warm_up()
@@ -9,5 +9,28 @@ from myapp import init_app
 
 app = init_app()
 
+
+def warm_up_worker(*args):
+	"""Warm up the worker, including its database connections."""
+	# Change 'myapp' to package name
+	from myapp.util import warm_up
+
+	with app.app_context():
+		warm_up()
+
+
+# Gunicorn hook, run with `gunicorn -c python:wsgi wsgi:app` so that the
+# application is initialized once and the hook uses the same instance
+post_fork = warm_up_worker
+
+# uWSGI hook, only available when running under uWSGI
+try:
+	from uwsgidecorators import postfork
+	postfork(warm_up_worker)
+
+except ImportError:
+	pass
+
+
 if __name__ == '__main__':
 	app.run()
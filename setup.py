@@ -40,11 +40,21 @@ setup(
         'pytz>=2022.1',
     ],
     extras_require={
+        'cache': [
+            'redis>=4.3.4',
+        ],
+        'compression': [
+            'brotli>=1.0.9',
+        ],
         'dev': [
+            'brotli>=1.0.9',
             'rcssmin==1.1.0',
             'Flask-DebugToolbar>=0.13.1',
             'libsass>=0.21.0'
         ],
+        'metrics': [
+            'prometheus-client>=0.14.1',
+        ],
         'tasks': [
             'celery==5.2.7',
         ],
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    """Write a configuration file and point `APP_CONFIG` to it.
+
+    Returns:
+        Function to write the file with additional settings.
+    """
+    def write(**settings):
+        settings = dict({
+            'SECRET_KEY': 'test',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.sqlite'),
+            'TEMPLATES_CACHE_DIR': str(tmp_path / 'templates'),
+        }, **settings)
+
+        path = tmp_path / 'test.cfg'
+        path.write_text(''.join(
+            '{} = {!r}\n'.format(key, value) for key, value in settings.items()
+        ))
+        monkeypatch.setenv('APP_CONFIG', str(path))
+
+        return settings
+
+    return write
+
+
+@pytest.mark.parametrize('warm_up', [False, True])
+def test_compile_templates(config, warm_up):
+    settings = config(WARM_UP=warm_up)
+
+    # Extensions are global, so each application needs its own process
+    result = subprocess.run(
+        [sys.executable, '-m', 'app.cli', 'templates', 'compile'],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+    assert result.returncode == 0, result.stderr
+
+    compiled = int(result.stdout.split()[1])
+    assert compiled > 0
+    assert len(os.listdir(settings['TEMPLATES_CACHE_DIR'])) == compiled